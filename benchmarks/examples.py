@@ -0,0 +1,254 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 11, 2018
+
+@author: jrm
+
+Benchmark building the examples without the ui. Each example is built in
+it's own process several times and the compile, activation, mesh and per
+operation times and the peak memory used are saved to a json file.
+
+The shape caches are cleared before each build unless `--cache` is given so
+the times are for building from scratch.
+
+Usage
+-----
+
+    python benchmarks/examples.py [examples/gears.enaml ...] [--repeat 3]
+        [--output results.json] [--compare baseline.json]
+
+    #: Compare two previous runs without building anything
+    python benchmarks/examples.py --compare baseline.json results.json
+
+"""
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import traceback
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#: Metrics compared between runs, lower is better for all of them
+METRICS = ('compile', 'activate', 'mesh', 'peak_rss')
+
+
+def peak_rss():
+    """ Return the peak memory used by this process in MB """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #: It's in bytes on OSX and KB elsewhere
+    return rss/(1024.0*1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def build_example(path, cache=False):
+    """ Build the example once and return the times of each step """
+    from declaracad.cli import create_model
+    from declaracad.editor.builder import compile_source, exec_code
+    from declaracad.occ.plugin import collect_export_shapes
+    from declaracad.occ.impl.occ_cache import SHAPE_CACHE
+    from declaracad.occ.impl.occ_mesh import MESH_SERVICE
+    from declaracad.occ.impl.occ_profiler import PROFILER
+
+    if not cache:
+        SHAPE_CACHE.clear()
+        MESH_SERVICE.clear()
+    PROFILER.clear()
+    PROFILER.enabled = True
+
+    result = {}
+    t0 = time.time()
+    with open(path) as f:
+        source = f.read()
+    namespace = exec_code(compile_source(source, path), path)
+    t1 = time.time()
+    result['compile'] = t1-t0
+
+    model = create_model(namespace, 'Assembly')
+    t2 = time.time()
+    result['activate'] = t2-t1
+
+    #: Mesh the same way the viewer does
+    for s in collect_export_shapes([model], expand=True):
+        MESH_SERVICE.mesh(s.shape, *MESH_SERVICE.display_deflection(s.shape))
+    result['mesh'] = time.time()-t2
+
+    #: Total time of each type of operation
+    operations = {}
+    for r in PROFILER.get_records():
+        total, calls = operations.get(r.kind, (0, 0))
+        operations[r.kind] = (total+r.total, calls+r.calls)
+    result['operations'] = operations
+    PROFILER.enabled = False
+    model.destroy()
+    return result
+
+
+def run_example(args):
+    """ Build the example several times. This is run in a new process so
+    the peak memory is only for the example.
+
+    Returns
+    -------
+        result: dict
+            The time of each build, the best time of each operation, the
+            peak memory, and the error (if any)
+
+    """
+    path, repeat, cache = args
+    result = {'compile': [], 'activate': [], 'mesh': [], 'operations': {},
+              'error': ''}
+    try:
+        from declaracad.occ.impl.occ_cache import DISK_CACHE
+        DISK_CACHE.enabled = cache
+        for i in range(repeat):
+            r = build_example(path, cache)
+            for k in ('compile', 'activate', 'mesh'):
+                result[k].append(r[k])
+            for kind, (total, calls) in r['operations'].items():
+                best = result['operations'].get(kind)
+                if best is None or total < best['time']:
+                    result['operations'][kind] = {'time': total,
+                                                  'calls': calls}
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def run(paths, repeat, cache):
+    results = {}
+    for path in paths:
+        name = os.path.relpath(path, ROOT)
+        print("Building {}...".format(name))
+        #: Use a new process for each example to measure the memory
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            r = pool.apply(run_example, ((path, repeat, cache),))
+        finally:
+            pool.terminate()
+        if r['error']:
+            print(r['error'])
+        else:
+            print("  compile {:0.3f}s, activate {:0.3f}s, mesh {:0.3f}s, "
+                  "peak {:0.1f} MB".format(min(r['compile']),
+                                           min(r['activate']),
+                                           min(r['mesh']), r['peak_rss']))
+        results[name] = r
+    return {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'cache': cache,
+        },
+        'results': results,
+    }
+
+
+def best(result, metric):
+    """ Get the best value of the metric (or None if it's missing) """
+    value = result.get(metric)
+    if isinstance(value, list):
+        return min(value) if value else None
+    return value
+
+
+def compare(baseline, current, threshold):
+    """ Print the change of each metric between the runs and flag the ones
+    that got worse by more than the threshold.
+
+    Returns
+    -------
+        regressions: int
+            The number of regressions
+
+    """
+    regressions = 0
+    row = "{:<36} {:<24} {:>10} {:>10} {:>8}  {}"
+    print(row.format('Example', 'Metric', 'Baseline', 'Current', 'Change',
+                     ''))
+    for name, r in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None or base['error'] or r['error']:
+            continue
+        pairs = [(m, best(base, m), best(r, m)) for m in METRICS]
+        for kind, op in sorted(r['operations'].items()):
+            old = base['operations'].get(kind)
+            pairs.append((kind, old and old['time'], op['time']))
+        for metric, old, new in pairs:
+            if not old or new is None:
+                continue
+            change = (new-old)/old
+            flag = ''
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            elif change < -threshold:
+                flag = 'improved'
+            print(row.format(name[:36], metric[:24], "{:0.4f}".format(old),
+                             "{:0.4f}".format(new),
+                             "{:+0.1f}%".format(change*100), flag))
+    print("{} regressions (threshold {:0.0f}%)".format(regressions,
+                                                        threshold*100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark building the examples")
+    parser.add_argument('paths', nargs='*',
+                        help="Examples to build (default all)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of times to build each example")
+    parser.add_argument('--cache', action='store_true',
+                        help="Keep the shape caches between builds")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="File to save the results to")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help="Compare the results with a baseline. If two "
+                             "files are given they're compared without "
+                             "building anything")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes a baseline and optionally the results "
+                     "to compare with it")
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        paths = [os.path.abspath(p) for p in args.paths] or sorted(
+            glob.glob(os.path.join(ROOT, 'examples', '*.enaml')))
+        output = os.path.abspath(args.output)
+
+        #: Examples use paths relative to the root
+        os.chdir(ROOT)
+        current = run(paths, args.repeat, args.cache)
+        with open(output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print("Results saved to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
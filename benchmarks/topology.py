@@ -0,0 +1,128 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 4, 2018
+
+@author: jrm
+
+Benchmark the topology traversal used to lookup the edges, faces, etc.. of
+shapes. Pass a STEP, IGES or BRep file to use an imported shape otherwise a
+compound of boxes is generated.
+
+Usage
+-----
+
+    python benchmarks/topology.py [model.stp] [--boxes 5000] [--repeat 3]
+
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OCC.BRep import BRep_Builder
+from OCC.BRepPrimAPI import BRepPrimAPI_MakeBox
+from OCC.BRepTools import breptools_Read
+from OCC.IGESControl import IGESControl_Reader
+from OCC.IFSelect import IFSelect_RetDone
+from OCC.STEPControl import STEPControl_Reader
+from OCC.TopAbs import TopAbs_EDGE, TopAbs_FACE, TopAbs_VERTEX
+from OCC.TopExp import TopExp_Explorer
+from OCC.TopoDS import TopoDS_Compound, TopoDS_Shape
+from OCC.gp import gp_Pnt
+
+from declaracad.occ.impl.occ_shape import Topology
+
+
+def load(path):
+    """ Load a shape from a STEP, IGES or BRep file """
+    ext = os.path.splitext(path)[-1].lower()
+    if ext == '.brep':
+        shape = TopoDS_Shape()
+        breptools_Read(shape, path, BRep_Builder())
+        return shape
+    reader = IGESControl_Reader() if ext in ('.igs', '.iges') else \
+        STEPControl_Reader()
+    if reader.ReadFile(path) != IFSelect_RetDone:
+        raise ValueError("Failed to load: {}".format(path))
+    reader.TransferRoots()
+    return reader.OneShape()
+
+
+def generate(n):
+    """ Create a compound of n boxes """
+    builder = BRep_Builder()
+    compound = TopoDS_Compound()
+    builder.MakeCompound(compound)
+    for i in range(n):
+        box = BRepPrimAPI_MakeBox(gp_Pnt(2*(i % 100), 2*(i//100), 0), 1, 1, 1)
+        builder.Add(compound, box.Shape())
+    return compound
+
+
+def list_unique(shape, topology_type):
+    """ The original implementation which de-duplicated using a list """
+    hashes = []
+    explorer = TopExp_Explorer(shape, topology_type)
+    while explorer.More():
+        h = explorer.Current().__hash__()
+        if h not in hashes:
+            hashes.append(h)
+        explorer.Next()
+    return len(hashes)
+
+
+def timeit(f, repeat):
+    """ Return the result and best time of calling f """
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = f()
+        t = time.time()-t0
+        best = t if best is None else min(best, t)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the topology traversal")
+    parser.add_argument('path', nargs='?', help="Model to load")
+    parser.add_argument('--boxes', type=int, default=5000,
+                        help="Number of boxes to generate if no model is given")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', action='store_true',
+                        help="Also time the original list based lookup")
+    args = parser.parse_args()
+
+    shape = load(args.path) if args.path else generate(args.boxes)
+    #: Cold times use a new Topology each run so the traversal is timed,
+    #: warm times reuse one so the cached lookups are timed
+    print("{:<10} {:<20} {:>8} {:>10} {:>10}".format(
+        'Type', 'Method', 'Count', 'Cold (s)', 'Warm (s)'))
+    for name, t in (('vertices', TopAbs_VERTEX), ('edges', TopAbs_EDGE),
+                    ('faces', TopAbs_FACE)):
+        for ignore in (False, True):
+            items, cold = timeit(
+                lambda: list(getattr(Topology(
+                    shape, ignore_orientation=ignore), name)()), args.repeat)
+            topo = Topology(shape, ignore_orientation=ignore)
+            list(getattr(topo, name)())
+            items, warm = timeit(
+                lambda: list(getattr(topo, name)()), args.repeat)
+            method = 'ignore_orientation' if ignore else 'default'
+            print("{:<10} {:<20} {:>8} {:>10.4f} {:>10.4f}".format(
+                name, method, len(items), cold, warm))
+        if args.compare:
+            n, duration = timeit(lambda: list_unique(shape, t), args.repeat)
+            print("{:<10} {:<20} {:>8} {:>10.4f} {:>10}".format(
+                name, 'list (original)', n, duration, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 10, 2018
+
+@author: jrm
+"""
+import sys
+from declaracad.cli import main
+
+sys.exit(main())
@@ -0,0 +1,553 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 10, 2018
+
+@author: jrm
+"""
+import os
+import csv
+import sys
+import ast
+import math
+import time
+import decimal
+import argparse
+import itertools
+import traceback
+import multiprocessing
+from enaml.application import Application
+
+#: Bounding box columns
+BOUNDS = ('xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax')
+
+
+def get_application():
+    """ Get the application of this process creating a headless one if
+    needed.
+
+    """
+    app = Application.instance()
+    if app is None:
+        from declaracad.core.headless import HeadlessApplication
+        app = HeadlessApplication()
+    return app
+
+
+#: Namespaces of the files loaded in this process by path
+_NAMESPACES = {}
+
+
+def load_namespace(path):
+    """ Compile and execute the enaml file and return it's namespace. The
+    namespace is reused until the file is modified.
+
+    """
+    from declaracad.editor.builder import compile_source, exec_code
+    mtime = os.path.getmtime(path)
+    entry = _NAMESPACES.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    with open(path) as f:
+        source = f.read()
+    namespace = exec_code(compile_source(source, path), path)
+    _NAMESPACES[path] = (mtime, namespace)
+    return namespace
+
+
+def create_model(namespace, target='Assembly', params=None, timeout=None):
+    """ Create the given enamldef from the namespace and build it without a
+    viewer.
+
+    Parameters
+    ----------
+        namespace: dict
+            Namespace of the enaml file
+        target: str
+            Name of the enamldef to build
+        params: dict
+            Values of the attributes of the enamldef to set
+        timeout: float
+            Maximum time in seconds to wait for shapes loading in the
+            background
+
+    Returns
+    -------
+        model: Shape
+            The activated model
+
+    """
+    app = get_application()
+    cls = namespace.get(target)
+    if cls is None:
+        raise ValueError("{} is not defined".format(target))
+    model = cls(**(params or {}))
+    model.initialize()
+    model.activate_proxy()
+
+    #: Run any rebuilds that were queued and wait for background imports
+    if not app.process_events(busy=lambda: model.proxy.loading,
+                              timeout=timeout):
+        raise RuntimeError("Timed out building {}".format(target))
+    return model
+
+
+def load_model(path, timeout=None):
+    """ Compile the enaml file and build the `Assembly` it defines without
+    a viewer.
+
+    Parameters
+    ----------
+        path: str
+            Path of the enaml file
+        timeout: float
+            Maximum time in seconds to wait for shapes loading in the
+            background
+
+    Returns
+    -------
+        assembly: Part
+            The activated assembly
+
+    """
+    namespace = load_namespace(path)
+    if 'Assembly' not in namespace:
+        raise ValueError("{} does not define an Assembly".format(path))
+    return create_model(namespace, 'Assembly', timeout=timeout)
+
+
+def shape_properties(model):
+    """ Compute the volume, surface area and bounding box of the model
+
+    Returns
+    -------
+        props: dict
+            The 'volume', 'area', and bounds ('xmin', 'ymin', ... 'zmax')
+
+    """
+    from OCC.Bnd import Bnd_Box
+    from OCC.BRepBndLib import brepbndlib_Add
+    from OCC.BRepGProp import (
+        brepgprop_VolumeProperties, brepgprop_SurfaceProperties
+    )
+    from OCC.GProp import GProp_GProps
+    shape = model.proxy.shape
+    if hasattr(shape, 'Shape'):
+        shape = shape.Shape()
+    props = GProp_GProps()
+    brepgprop_VolumeProperties(shape, props)
+    volume = props.Mass()
+    props = GProp_GProps()
+    brepgprop_SurfaceProperties(shape, props)
+    result = {'volume': volume, 'area': props.Mass()}
+    box = Bnd_Box()
+    brepbndlib_Add(shape, box)
+    if not box.IsVoid():
+        result.update(zip(BOUNDS, box.Get()))
+    return result
+
+
+def find_exporter(path, format=None):
+    """ Find the exporter with the given id or by the extension of the path
+    """
+    from declaracad.occ.plugin import ExportError, get_exporters
+    exporters = get_exporters()
+    if format:
+        if format not in exporters:
+            raise ExportError("No exporter for {}, the formats are: {}".format(
+                format, ", ".join(exporters)))
+        return exporters[format]
+    ext = os.path.splitext(path)[-1].lower()
+    for exporter in exporters.values():
+        if exporter.extension == ext:
+            return exporter
+    raise ExportError("No exporter for `{}` files, use --format".format(ext))
+
+
+def export_model(assembly, options):
+    """ Export the built assembly in the current thread.
+
+    Returns
+    -------
+        paths: List of str
+            The files written
+
+    """
+    from declaracad.occ.plugin import (
+        ExportError, ExportJob, collect_export_shapes
+    )
+    exporter = find_exporter(options.path, options.format)
+    options.format = exporter.id
+    shapes = collect_export_shapes([assembly], exporter.expand)
+    job = ExportJob(exporter=exporter, options=options, shapes=shapes)
+    job.run()
+
+    #: Apply the job state
+    get_application().process_events()
+    if job.error:
+        raise ExportError(job.error)
+    return job.paths
+
+
+def build_file(args):
+    """ Build and optionally export a single file. This is run in a worker
+    process when building multiple files.
+
+    Returns
+    -------
+        result: dict
+            The path, files written, duration, and error (if any)
+
+    """
+    path, options, timeout = args
+    result = {'path': path, 'paths': [], 'error': ''}
+    start = time.time()
+    try:
+        assembly = load_model(path, timeout)
+        result['built'] = time.time()-start
+        if options is not None:
+            from declaracad.occ.plugin import ExportOptions
+            result['paths'] = export_model(assembly, ExportOptions(**options))
+        assembly.destroy()
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['duration'] = time.time()-start
+    return result
+
+
+def export_options(args, path):
+    """ Create the export options (as a dict so they can be passed to a
+    worker) from the parsed arguments.
+
+    """
+    return dict(
+        path=path,
+        format=args.format or '',
+        linear_deflection=args.linear_deflection,
+        angular_deflection=args.angular_deflection,
+        relative=args.relative,
+        binary=args.binary,
+        split=args.split,
+        jobs=args.jobs,
+    )
+
+
+def run_tasks(function, tasks, jobs=0):
+    """ Run the function with each task in a pool of worker processes
+    (unless only one is needed) and yield the results as they finish.
+
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs < 2:
+        for task in tasks:
+            yield function(task)
+        return
+    #: Workers can't start another pool so each meshes in process
+    for task in tasks:
+        options = task[-2]
+        if options is not None:
+            options['jobs'] = 1
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(function, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def build(args):
+    """ Build the files given in the parsed arguments """
+    tasks = []
+    for path in args.files:
+        options = None
+        if args.export:
+            name = os.path.splitext(os.path.basename(path))[0]
+            options = export_options(args, args.export.format(name=name))
+        tasks.append((path, options, args.timeout))
+
+    failed = 0
+    for r in run_tasks(build_file, tasks, args.jobs):
+        if r['error']:
+            failed += 1
+            print("FAILED {}\n{}".format(r['path'], r['error']))
+            continue
+        print("OK {} ({:0.2f}s){}".format(
+            r['path'], r['duration'],
+            " -> {}".format(", ".join(r['paths'])) if r['paths'] else ""))
+    print("Built {} of {} files".format(len(tasks)-failed, len(tasks)))
+    return 1 if failed else 0
+
+
+# -----------------------------------------------------------------------------
+# Parameter sweeps
+# -----------------------------------------------------------------------------
+def parse_value(value):
+    """ Parse a python literal falling back to the string """
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+#: Placeholders of the export path that can't be used as parameter names
+RESERVED_PARAMS = ('name', 'index')
+
+
+def decimal_places(value):
+    """ Return the number of decimal places of the number """
+    exponent = decimal.Decimal(str(value)).as_tuple().exponent
+    return max(0, -exponent)
+
+
+def parse_param(param):
+    """ Parse a parameter given as "name=1,2,3" or "name=start:stop:step"
+    where the stop is included. Ranges are ints if the start, stop, and step
+    are all ints.
+
+    Returns
+    -------
+        param: tuple
+            The name and list of values
+
+    """
+    name, sep, values = param.partition('=')
+    if not sep or not name.strip():
+        raise ValueError("Invalid parameter `{}`, expected "
+                         "name=value1,value2 or name=start:stop:step".format(
+                            param))
+    name = name.strip()
+    if name in RESERVED_PARAMS:
+        raise ValueError("Invalid parameter `{}`, {} are reserved for the "
+                         "export path".format(name, ", ".join(RESERVED_PARAMS)))
+    if ':' in values:
+        bounds = [parse_value(v.strip()) for v in values.split(':')]
+        if len(bounds) != 3 or not all(
+                isinstance(v, (int, float)) and not isinstance(v, bool)
+                for v in bounds):
+            raise ValueError("Invalid range `{}`, expected numbers as "
+                             "start:stop:step".format(values))
+        start, stop, step = bounds
+        if step <= 0:
+            raise ValueError("The step of `{}` must be positive".format(name))
+        if all(isinstance(v, int) for v in bounds):
+            return name, list(range(start, stop+1, step))
+        #: The tolerance keeps the stop when it's a multiple of the step
+        n = int(math.floor((stop-start)/step + 1e-9))
+        places = max(decimal_places(v) for v in bounds)
+        return name, [round(start+i*step, places) for i in range(n+1)]
+    return name, [parse_value(v.strip()) for v in values.split(',')]
+
+
+def parameter_grid(params):
+    """ Generate every combination of the parameter values
+
+    Parameters
+    ----------
+        params: List of tuple
+            The name and values of each parameter
+
+    Returns
+    -------
+        grid: List of dict
+            The values of each variant
+
+    """
+    names = [name for name, values in params]
+    return [dict(zip(names, values))
+            for values in itertools.product(*[v for n, v in params])]
+
+
+def build_variant(args):
+    """ Build a variant of the target with the given parameters, compute
+    it's properties and optionally export it. This is run in a worker
+    process.
+
+    Returns
+    -------
+        result: dict
+            The index, parameters, properties, files written, duration, and
+            error (if any)
+
+    """
+    index, path, target, params, options, timeout = args
+    result = {'index': index, 'params': params, 'paths': [], 'error': ''}
+    start = time.time()
+    try:
+        model = create_model(load_namespace(path), target, params, timeout)
+        result.update(shape_properties(model))
+        if options is not None:
+            from declaracad.occ.plugin import ExportOptions
+            result['paths'] = export_model(model, ExportOptions(**options))
+        model.destroy()
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['duration'] = time.time()-start
+    return result
+
+
+def run_sweep(path, params, target='Assembly', export=None, options=None,
+              jobs=0, timeout=None):
+    """ Build every combination of the parameters in parallel.
+
+    Parameters
+    ----------
+        path: str
+            Path of the enaml file
+        params: List of tuple
+            The name and values of each attribute to sweep
+        target: str
+            Name of the enamldef to build
+        export: str
+            If given, export each variant to this path which is formatted
+            with the `name` of the file, the `index` of the variant, and
+            each parameter (ex. "out/{name}-{index}.stl")
+        options: dict
+            Other export options
+        jobs: int
+            Number of processes to use (0 uses all cores)
+        timeout: float
+            Maximum time in seconds to wait for each variant
+
+    Returns
+    -------
+        results: generator
+            Yields the result of each variant as it finishes
+
+    Raises
+    ------
+        ValueError: If the export path is invalid or is the same for more
+            than one variant
+
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    tasks = []
+    paths = set()
+    for index, values in enumerate(parameter_grid(params)):
+        opts = None
+        if export:
+            opts = dict(options or {})
+            try:
+                opts['path'] = export.format(name=name, index=index, **values)
+            except (KeyError, IndexError, ValueError) as e:
+                raise ValueError("Invalid export path `{}`: {}".format(
+                    export, e))
+            if opts['path'] in paths:
+                raise ValueError("The export path `{}` must be unique for "
+                                 "each variant, use {{index}} or the "
+                                 "parameter names".format(export))
+            paths.add(opts['path'])
+        tasks.append((index, path, target, values, opts, timeout))
+    return run_tasks(build_variant, tasks, jobs)
+
+
+def sweep(args):
+    """ Run the sweep given in the parsed arguments and write the results
+    to a csv file.
+
+    """
+    options = export_options(args, '') if args.export else None
+    try:
+        params = [parse_param(p) for p in args.param]
+        results = run_sweep(args.file, params, args.target, args.export,
+                            options, args.jobs, args.timeout)
+    except ValueError as e:
+        print(e)
+        return 1
+    names = [name for name, values in params]
+    columns = (['index']+names+['volume', 'area']+list(BOUNDS) +
+               ['duration', 'paths', 'error'])
+    failed = total = 0
+    with open(args.output, 'w') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        for r in results:
+            total += 1
+            row = dict(r)
+            row.update(r['params'])
+            row['paths'] = ";".join(r['paths'])
+            if r['error']:
+                failed += 1
+                print("FAILED {} {}\n{}".format(r['index'], r['params'],
+                                                r['error']))
+                row['error'] = r['error'].strip().split("\n")[-1]
+            else:
+                print("OK {} {} ({:0.2f}s)".format(r['index'], r['params'],
+                                                   r['duration']))
+            writer.writerow(row)
+    print("Built {} of {} variants, results saved to {}".format(
+        total-failed, total, args.output))
+    return 1 if failed else 0
+
+
+def add_export_arguments(p):
+    p.add_argument('-f', '--format',
+                   help="Id of the exporter to use instead of the one for "
+                        "the extension of the export path")
+    p.add_argument('-j', '--jobs', type=int, default=0,
+                   help="Number of processes to use (0 uses all cores)")
+    p.add_argument('--linear-deflection', type=float, default=0.05,
+                   help="Linear deflection used when meshing")
+    p.add_argument('--angular-deflection', type=float, default=0.5,
+                   help="Angular deflection used when meshing")
+    p.add_argument('--relative', action='store_true',
+                   help="Use a deflection relative to the size of each edge")
+    p.add_argument('--binary', action='store_true',
+                   help="Export binary STL files")
+    p.add_argument('--split', action='store_true',
+                   help="Export each part to a separate file")
+    p.add_argument('--timeout', type=float, default=None,
+                   help="Maximum time in seconds to wait for each model")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='declaracad',
+        description="Build declaracad models without the ui")
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('build', help="Build and export models")
+    p.add_argument('files', nargs='+', help="Enaml files to build")
+    p.add_argument('-e', '--export',
+                   help="Export each model to this path. When building "
+                        "multiple files use {name} for the name of the file "
+                        "(ex. out/{name}.step)")
+    add_export_arguments(p)
+
+    p = commands.add_parser('sweep', help="Build every combination of the "
+                                          "parameters of a model")
+    p.add_argument('file', help="Enaml file to build")
+    p.add_argument('-t', '--target', default='Assembly',
+                   help="Name of the enamldef to build")
+    p.add_argument('-p', '--param', action='append', default=[],
+                   help="Attribute to sweep as name=value1,value2,... or "
+                        "name=start:stop:step (including the stop)")
+    p.add_argument('-o', '--output', default='sweep.csv',
+                   help="CSV file to save the properties of each variant")
+    p.add_argument('-e', '--export',
+                   help="Export each variant to this path. Use {index} and "
+                        "the parameter names to make it unique (parameters "
+                        "can't be named name or index) "
+                        "(ex. out/{name}-{index}.stl)")
+    add_export_arguments(p)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.command == 'sweep':
+        if not args.param:
+            parser.error("At least one --param is required")
+        return sweep(args)
+    if (args.export and len(args.files) > 1 and
+            '{name}' not in args.export):
+        parser.error("--export must contain {name} when building "
+                     "multiple files")
+    return build(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 10, 2018
+
+@author: jrm
+"""
+import time
+import heapq
+import itertools
+import threading
+from atom.api import Value
+from enaml.application import Application
+from enaml.proxy_resolver import ProxyResolver
+
+
+class HeadlessApplication(Application):
+    """ An application that resolves the OCC proxies without creating any
+    widgets so models can be built without a display server.
+
+    Calls made with `deferred_call` and `timed_call` are queued and only
+    invoked from `process_events`.
+
+    """
+
+    #: Heap of (due time, order, callback, args, kwargs)
+    _tasks = Value(factory=list)
+
+    #: Used to keep tasks with the same due time in order
+    _counter = Value(factory=itertools.count)
+
+    #: Notified when a task is added from another thread
+    _condition = Value(factory=threading.Condition)
+
+    #: Thread the application was created in
+    _thread = Value(factory=threading.current_thread)
+
+    def __init__(self):
+        super(HeadlessApplication, self).__init__()
+        from enaml.qt.qt_factories import QT_FACTORIES
+        from declaracad import occ
+        occ.install()
+        self.resolver = ProxyResolver(factories=QT_FACTORIES)
+
+    # -------------------------------------------------------------------------
+    # Application API
+    # -------------------------------------------------------------------------
+    def start(self):
+        self.process_events()
+
+    def stop(self):
+        with self._condition:
+            del self._tasks[:]
+
+    def deferred_call(self, callback, *args, **kwargs):
+        self.timed_call(0, callback, *args, **kwargs)
+
+    def timed_call(self, ms, callback, *args, **kwargs):
+        with self._condition:
+            heapq.heappush(self._tasks, (time.time()+ms/1000.0,
+                                         next(self._counter), callback, args,
+                                         kwargs))
+            self._condition.notify()
+
+    def is_main_thread(self):
+        return threading.current_thread() is self._thread
+
+    def create_mime_data(self):
+        raise NotImplementedError
+
+    # -------------------------------------------------------------------------
+    # Headless API
+    # -------------------------------------------------------------------------
+    def process_events(self, busy=None, timeout=None):
+        """ Invoke the queued calls as they become due until there are none
+        left.
+
+        Parameters
+        ----------
+            busy: callable
+                If given, keep waiting for calls while this returns True
+                (ex. while shapes are loading in the background)
+            timeout: float
+                Maximum time to wait in seconds
+
+        Returns
+        -------
+            done: bool
+                False if the timeout expired first
+
+        """
+        end = None if timeout is None else time.time()+timeout
+        while True:
+            with self._condition:
+                if not self._tasks and not (busy and busy()):
+                    return True
+                now = time.time()
+                if end is not None and now >= end:
+                    return False
+                if self._tasks and self._tasks[0][0] <= now:
+                    task = heapq.heappop(self._tasks)
+                else:
+                    #: Wait for the next task to be due or to be added
+                    due = self._tasks[0][0] if self._tasks else now+0.1
+                    if end is not None:
+                        due = min(due, end)
+                    self._condition.wait(max(0, due-now))
+                    continue
+            due, i, callback, args, kwargs = task
+            callback(*args, **kwargs)
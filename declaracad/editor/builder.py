@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2017, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 2, 2018
+
+@author: jrm
+"""
+import os
+import re
+import sys
+import enaml
+import time
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from atom.api import (
+    Atom, Unicode, Bool, Int, Float, List, Dict, Set, Typed, Instance,
+    Callable, Value
+)
+from enaml.application import deferred_call, timed_call
+from enaml.core.enaml_compiler import EnamlCompiler
+from enaml.core.parser import parse
+from types import ModuleType
+from future.utils import exec_
+from declaracad.core.api import log
+from declaracad.occ.impl.occ_profiler import PROFILER
+from declaracad.occ.impl.occ_scheduler import SCHEDULER
+from .reconcile import ReconcileError, Reconciler, Snapshot
+
+
+class BuildCancelled(Exception):
+    """ Raised within the worker when a newer build has superseded the
+    one being built.
+    """
+
+
+def compile_source(source, filename):
+    """ Parse and compile the enaml source into a code object.
+
+    Parameters
+    ----------
+        source: str
+            The enaml source code
+        filename: str
+            Filename used for reporting errors
+
+    Returns
+    -------
+        code: CodeType
+            The compiled code object
+    """
+    ast = parse(source, filename=filename)
+    return EnamlCompiler.compile(ast, filename)
+
+
+def exec_code(code, filename):
+    """ Execute the compiled code as the `__main__` module and return its
+    namespace.
+
+    """
+    module = ModuleType('__main__')
+    module.__file__ = filename
+    namespace = module.__dict__
+    with enaml.imports():
+        exec_(code, namespace)
+    return namespace
+
+
+def create_assembly(namespace):
+    """ Create the `Assembly` defined in the namespace (if any) and activate
+    it's proxy tree so all the shapes are built.
+
+    """
+    Assembly = namespace.get('Assembly')
+    if Assembly is None:
+        return None
+    assembly = Assembly()
+    assembly.initialize()
+    assembly.activate_proxy()
+    return assembly
+
+
+def format_error(filename, tb):
+    """ Convert the formatted traceback into an error in the same format
+    used by the linter "<file>:<line>: <message>".
+
+    """
+    lines = tb.strip().split("\n")
+    if len(lines) < 3:
+        return None
+    m = re.search(r'File "(.+)", line (\d+),', lines[-3])
+    if m:
+        return "{}:{}: {}".format(m.group(1), m.group(2), lines[-1])
+
+
+def file_hash(path):
+    """ Return the sha1 of the contents of the file """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def module_dependencies(module):
+    """ Get the names of the modules the module uses based on the modules,
+    classes and functions in it's namespace.
+
+    """
+    names = set()
+    for v in list(vars(module).values()):
+        if isinstance(v, ModuleType):
+            names.add(v.__name__)
+            continue
+        try:
+            name = getattr(v, '__module__', None)
+        except Exception:
+            continue
+        if isinstance(name, str):
+            names.add(name)
+    return names
+
+
+class CompileCache(Atom):
+    """ Caches the code compiled from the source of a document by a hash of
+    the source and tracks the project modules the documents import.
+
+    Imported modules are left in `sys.modules` so they are reused by the
+    next build. Before each build any module whose file changed, and every
+    module that depends on it, is removed so it's imported again.
+
+    """
+
+    #: Maximum number of compiled sources to keep
+    limit = Int(32)
+
+    #: Packages that are never reloaded even if they're in a project
+    #: directory (ex. when running from a checkout)
+    excluded = Set(default=set(['declaracad', 'enaml', 'atom', 'OCC']))
+
+    #: Stats
+    hits = Int()
+    misses = Int()
+    reloaded = Int()
+
+    #: Code by source hash in least recently used order
+    _code = Typed(OrderedDict, ())
+
+    #: Project modules by name with the (path, mtime, size, hash) of the
+    #: file they were imported from
+    _modules = Dict()
+
+    _lock = Value(factory=threading.Lock)
+
+    def compile(self, source, filename):
+        """ Compile the source or return the code from the last time it was
+        compiled.
+
+        """
+        key = hashlib.sha1(
+            u'{}\0{}'.format(filename, source).encode('utf-8')).hexdigest()
+        with self._lock:
+            code = self._code.pop(key, None)
+            if code is not None:
+                self._code[key] = code
+                self.hits += 1
+                return code
+        code = compile_source(source, filename)
+        with self._lock:
+            self.misses += 1
+            self._code[key] = code
+            while len(self._code) > self.limit:
+                self._code.popitem(last=False)
+        return code
+
+    def refresh_modules(self):
+        """ Remove the project modules that changed, or depend on one that
+        changed, from `sys.modules`.
+
+        Returns
+        -------
+            names: set
+                The names of the modules removed
+
+        """
+        changed = set()
+        for name, (path, mtime, size, digest) in list(self._modules.items()):
+            if name not in sys.modules:
+                changed.add(name)
+                continue
+            try:
+                stat = os.stat(path)
+                if (stat.st_mtime, stat.st_size) == (mtime, size):
+                    continue
+                if file_hash(path) == digest:
+                    #: Only touched
+                    self._modules[name] = (path, stat.st_mtime,
+                                           stat.st_size, digest)
+                    continue
+            except (IOError, OSError):
+                pass
+            changed.add(name)
+
+        if changed:
+            #: Also remove every module that uses a changed one
+            dependencies = {}
+            for name in self._modules:
+                module = sys.modules.get(name)
+                if module is not None:
+                    dependencies[name] = module_dependencies(module)
+            stale = set(changed)
+            while True:
+                names = set(n for n, deps in dependencies.items()
+                            if n not in stale and deps & stale)
+                if not names:
+                    break
+                stale |= names
+            for name in stale:
+                sys.modules.pop(name, None)
+                self._modules.pop(name, None)
+            self.reloaded += len(stale)
+            log.debug("Reloading modules: {}".format(stale))
+            return stale
+        return set()
+
+    def track_modules(self, paths, names):
+        """ Record the given modules if they were imported from one of the
+        project directories so they can be reloaded when they change.
+
+        """
+        paths = [os.path.join(os.path.abspath(p), '') for p in paths if p]
+        for name in names:
+            module = sys.modules.get(name)
+            if (module is None or name in self._modules or
+                    name == '__main__' or
+                    name.split('.')[0] in self.excluded):
+                continue
+            filename = getattr(module, '__file__', None)
+            if not filename:
+                continue
+            filename = os.path.abspath(filename)
+            if (os.path.splitext(filename)[-1] not in ('.py', '.enaml') or
+                    'site-packages' in filename or
+                    not any(filename.startswith(p) for p in paths)):
+                continue
+            try:
+                stat = os.stat(filename)
+                self._modules[name] = (filename, stat.st_mtime,
+                                       stat.st_size, file_hash(filename))
+            except (IOError, OSError):
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._code.clear()
+        for name in self._modules:
+            sys.modules.pop(name, None)
+        self._modules = {}
+
+    def stats(self):
+        """ Return the stats of the cache """
+        return {
+            'entries': len(self._code),
+            'modules': len(self._modules),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloaded': self.reloaded,
+        }
+
+
+class BuildRequest(Atom):
+    """ A request to build the source of a document. """
+
+    #: Generation of the source this request builds
+    generation = Int()
+
+    #: Source to build
+    source = Unicode()
+
+    #: Filename of the source
+    filename = Unicode()
+
+    #: Called on the main thread with the finished request
+    callback = Callable()
+
+    #: Set when a newer request superseded this one
+    cancelled = Bool()
+
+    #: Snapshot of the live assembly taken when the request was submitted
+    snapshot = Value()
+
+    #: Result of the build
+    assembly = Value()
+
+    #: Set when the assembly can be reconciled with the live assembly
+    reconcile = Bool()
+
+    #: Changes planned to reconcile the assembly with the live assembly
+    reconciler = Value()
+
+    #: Formatted traceback if the build failed
+    error = Unicode()
+
+    #: Time the build took in seconds
+    duration = Float()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise BuildCancelled()
+
+
+class ModelBuilder(Atom):
+    """ Compiles and builds models in a background worker thread so the
+    editor stays responsive.
+
+    Every change of the source is tagged with an increasing generation
+    number and debounced using a window based on how long recent builds
+    took. Only the latest generation is ever built, any pending or running
+    builds are cancelled when a newer one is submitted and results from
+    superseded generations are dropped.
+
+    The status members are only modified from the main thread so they can be
+    safely bound to the ui.
+
+    """
+
+    #: Latest generation of the source
+    generation = Int()
+
+    #: Generation of the build that is currently running
+    running = Int()
+
+    #: Number of changes waiting for the debounce window to expire
+    #: or for the worker to become available
+    queued = Int()
+
+    #: Number of builds that completed and were applied
+    completed = Int()
+
+    #: Number of builds that were superseded and dropped
+    dropped = Int()
+
+    #: Duration of the most recent builds in seconds
+    durations = List(Float())
+
+    #: Number of build durations to keep
+    duration_history = Int(5)
+
+    #: Minimum and maximum debounce window in ms
+    debounce_min = Int(0)
+    debounce_max = Int(2000)
+
+    #: Fraction of the average build time to wait for more changes
+    debounce_factor = Float(0.5)
+
+    #: Compiled code and imported modules reused between builds
+    cache = Instance(CompileCache, ())
+
+    #: Directories of the project modules that may be imported
+    sys_path = List()
+
+    #: Update the live assembly in place instead of replacing it when the
+    #: structure of the new one matches
+    reconcile = Bool(True)
+
+    #: Assembly currently displayed and the file it was built from. The
+    #: worker never reads it, a snapshot of it is passed with each request.
+    live = Value()
+    live_filename = Unicode()
+
+    #: Request currently being built
+    active = Instance(BuildRequest)
+
+    #: Request waiting to be built
+    pending = Instance(BuildRequest)
+
+    #: Worker thread
+    _thread = Instance(threading.Thread)
+
+    #: Signals the worker when a request is pending
+    _condition = Instance(threading.Condition, ())
+
+    # -------------------------------------------------------------------------
+    # Main thread API
+    # -------------------------------------------------------------------------
+    def debounce_interval(self):
+        """ Determine how long to wait for more changes before building based
+        on the average duration of the recent builds.
+
+        Returns
+        -------
+            interval: int
+                Interval in ms
+        """
+        if not self.durations:
+            return self.debounce_min
+        avg = sum(self.durations) / len(self.durations)
+        interval = int(avg * 1000 * self.debounce_factor)
+        return min(self.debounce_max, max(self.debounce_min, interval))
+
+    def schedule(self, source, filename, callback):
+        """ Schedule the source to be built once the debounce window expires.
+        If the source changes again before then this generation is dropped.
+        The callback will be invoked on the main thread with the
+        `BuildRequest` only if the build is still the latest generation.
+
+        Returns
+        -------
+            generation: int
+                The generation assigned to this source
+        """
+        self.generation += 1
+        self.queued += 1
+        timed_call(self.debounce_interval(), self._debounced,
+                   self.generation, source, filename, callback)
+        return self.generation
+
+    def _debounced(self, generation, source, filename, callback):
+        """ Submit the build if no newer changes came in """
+        if generation != self.generation:
+            self.queued -= 1
+            self.dropped += 1
+            return
+        self.submit(source, filename, callback, generation)
+        self.queued -= 1
+
+    def submit(self, source, filename, callback, generation=None):
+        """ Queue the source to be built immediately by the worker.
+
+        """
+        if generation is None:
+            self.generation += 1
+            generation = self.generation
+        request = BuildRequest(generation=generation, source=source,
+                               filename=filename, callback=callback,
+                               snapshot=self.snapshot(filename))
+        with self._condition:
+            if self.pending:
+                self.pending.cancelled = True
+            if self.active:
+                self.active.cancelled = True
+            self.pending = request
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='declaracad-builder')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return request
+
+    def snapshot(self, filename):
+        """ Take a snapshot of the live assembly if the build of the file
+        may be reconciled with it.
+
+        """
+        live = self.live
+        if (not self.reconcile or live is None or
+                not live.proxy_is_active or self.live_filename != filename):
+            return None
+        try:
+            return Snapshot(live)
+        except Exception as e:
+            log.debug("Could not take a snapshot of {}: {}".format(live, e))
+            return None
+
+    def _on_started(self, request):
+        self.running = request.generation
+
+    def _on_finished(self, request):
+        """ Apply the result if it's still the latest generation """
+        if self.running == request.generation:
+            self.running = 0
+        if request.cancelled or request.generation != self.generation:
+            self.dropped += 1
+            if request.assembly is not None:
+                request.assembly.destroy()
+            return
+        self.completed += 1
+        self.durations = (self.durations +
+                          [request.duration])[-self.duration_history:]
+        request.callback(request)
+
+    # -------------------------------------------------------------------------
+    # Worker thread API
+    # -------------------------------------------------------------------------
+    def _run(self):
+        """ Worker thread loop """
+        while True:
+            with self._condition:
+                while self.pending is None:
+                    self._condition.wait()
+                request = self.active = self.pending
+                self.pending = None
+            deferred_call(self._on_started, request)
+            start = time.time()
+            try:
+                self.build(request)
+            except BuildCancelled:
+                log.debug("Build {} cancelled".format(request.generation))
+            finally:
+                #: Drop anything left from a cancelled or failed build
+                SCHEDULER.clear()
+                request.duration = time.time() - start
+                with self._condition:
+                    self.active = None
+            deferred_call(self._on_finished, request)
+
+    def plan(self, request):
+        """ Plan the changes to reconcile the new assembly with the snapshot
+        of the live one.
+
+        """
+        snapshot, assembly = request.snapshot, request.assembly
+        if snapshot is None or assembly is None:
+            return
+        reconciler = Reconciler()
+        try:
+            reconciler.plan(snapshot, assembly)
+        except ReconcileError as e:
+            log.debug(e)
+            return
+        request.reconciler = reconciler
+        request.reconcile = True
+
+    def build(self, request):
+        """ Build the request, this is invoked from the worker thread. """
+        cache = self.cache
+        paths = self.sys_path+[os.path.dirname(request.filename)]
+        sys_path = sys.path[:]
+        try:
+            code = cache.compile(request.source, request.filename)
+            request.check_cancelled()
+            cache.refresh_modules()
+            for path in paths:
+                if path and path not in sys.path:
+                    sys.path.append(path)
+            imported = set(sys.modules)
+            try:
+                namespace = exec_code(code, request.filename)
+            finally:
+                #: Only the modules imported by this document
+                cache.track_modules(paths, set(sys.modules)-imported)
+            request.check_cancelled()
+            if PROFILER.enabled:
+                PROFILER.clear()
+            request.assembly = create_assembly(namespace)
+
+            #: Rebuild the shapes queued while activating in this thread so
+            #: the tree is complete before it's passed to the main thread
+            SCHEDULER.flush()
+            request.check_cancelled()
+            self.plan(request)
+        except BuildCancelled:
+            raise
+        except Exception:
+            request.error = traceback.format_exc()
+        finally:
+            sys.path[:] = sys_path
@@ -0,0 +1,186 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 14, 2018
+
+@author: jrm
+"""
+import os
+import jedi
+from atom.api import Atom, Bool, Int, Float, List, Value
+from declaracad.core.api import log
+
+
+class CompletionService(Atom):
+    """ Provides autocomplete suggestions using jedi.
+
+    jedi keeps the modules it parsed in memory so they are reused by every
+    completion made in this process. The modules commonly used in models
+    (which includes the large OCC modules) are preloaded in the background
+    on startup so the first completions don't have to wait for them. Each
+    module is preloaded by a separate low priority task so linting and
+    completions requested meanwhile only wait for the current module.
+
+    `preload` and `complete` must be invoked from the same (worker) thread
+    as jedi is not thread safe. The status members are only modified from
+    the main thread so they can be bound to the ui.
+
+    """
+
+    #: Paths to search for modules
+    sys_path = List()
+
+    #: Modules to preload
+    modules = List(default=[
+        'declaracad.occ.api',
+        'enaml.core.api',
+        'OCC.gp',
+        'OCC.TopoDS',
+        'OCC.BRepPrimAPI',
+        'OCC.BRepAlgoAPI',
+        'OCC.BRepBuilderAPI',
+    ])
+
+    #: Set once the modules were preloaded
+    indexed = Bool()
+
+    #: Number of modules preloaded
+    preloaded = Int()
+
+    #: Time it took to preload the modules in seconds
+    index_duration = Float()
+
+    #: Number of completions made
+    requests = Int()
+
+    #: Duration of the most recent completions in seconds
+    latencies = List(Float())
+
+    #: Number of latencies to keep
+    history = Int(100)
+
+    #: jedi project (only used when supported by the jedi version)
+    _project = Value()
+
+    def _observe_sys_path(self, change):
+        #: Recreated by the worker when next needed
+        self._project = None
+
+    # -------------------------------------------------------------------------
+    # Worker thread API
+    # -------------------------------------------------------------------------
+    def get_project(self):
+        """ Get the jedi project for the sys path or None if the jedi
+        version does not support them.
+
+        """
+        if not hasattr(jedi, 'Project'):
+            return None
+        project = self._project
+        if project is None:
+            sys_path = [p for p in self.sys_path if p]
+            path = sys_path[0] if sys_path else os.getcwd()
+            project = self._project = jedi.Project(path,
+                                                   added_sys_path=sys_path)
+        return project
+
+    def preload(self, name):
+        """ Parse the module so it's in jedi's cache """
+        try:
+            jedi.preload_module(name)
+        except Exception as e:
+            log.debug("Could not preload {}: {}".format(name, e))
+
+    def get_completions(self, source, line, column):
+        """ Get the jedi completions at the position. The line starts at 1.
+
+        """
+        project = self.get_project()
+        if project is not None:
+            script = jedi.Script(source, project=project)
+            return script.complete(line, column)
+        script = jedi.Script(source, line, column, sys_path=self.sys_path)
+        return script.completions()
+
+    def complete(self, source, cursor):
+        """ Return a list of autocomplete suggestions for the given text.
+
+        Parameters
+        ----------
+            source: str
+                Source code to autocomplete
+            cursor: (line, column)
+                Position of the editor
+        Return
+        ------
+            result: list
+                List of autocompletion strings
+        """
+        try:
+            #: The editor only requests completions after a name or
+            #: attribute was typed, this guards against any other requests
+            line, column = cursor
+            lines = source.split("\n")
+            prefix = lines[line][:column] if line < len(lines) else ""
+            if not prefix or not (prefix[-1] in '._' or prefix[-1].isalnum()):
+                return []
+
+            #: Get suggestions
+            results = []
+            for c in self.get_completions(source, line+1, column):
+                results.append(c.name)
+
+                #: Try to get a signature if the docstring matches
+                #: something Scintilla will use (ex "func(..." or "Class(...")
+                #: Scintilla ignores docstrings without a comma in the args
+                if c.type in ['function', 'class', 'instance']:
+                    docstring = c.docstring()
+
+                    #: Remove self arg
+                    docstring = docstring.replace("(self,", "(")
+
+                    if docstring.startswith("{}(".format(c.name)):
+                        results.append(docstring)
+                        continue
+
+            return results
+        except Exception:
+            #: Autocompletion may fail for random reasons so catch all errors
+            #: as we don't want the editor to exit because of this
+            return []
+
+    # -------------------------------------------------------------------------
+    # Main thread API
+    # -------------------------------------------------------------------------
+    def record_preload(self, duration):
+        """ Record that a module was preloaded """
+        self.preloaded += 1
+        self.index_duration += duration
+        self.indexed = self.preloaded >= len(self.modules)
+
+    def record(self, duration):
+        """ Record the duration of a completion """
+        self.requests += 1
+        self.latencies = (self.latencies+[duration])[-self.history:]
+
+    def stats(self):
+        """ Return the latency stats of the recent completions in ms """
+        stats = {
+            'requests': self.requests,
+            'indexed': self.indexed,
+            'index_duration': self.index_duration,
+        }
+        latencies = sorted(self.latencies)
+        if latencies:
+            n = len(latencies)
+            stats.update({
+                'mean': 1000*sum(latencies)/n,
+                'p50': 1000*latencies[n//2],
+                'p95': 1000*latencies[min(n-1, int(n*0.95))],
+                'max': 1000*latencies[-1],
+            })
+        return stats
@@ -6,11 +6,28 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 import io
+import os
 import sys
+import ast
 import _ast
+import hashlib
+import threading
+from collections import OrderedDict
+from atom.api import Atom, Int, Typed, Value
+from enaml.core import enaml_ast
+from enaml.core.parser import parse
+from pyflakes import messages
 from pyflakes.reporter import Reporter
 from pyflakes.checker import Checker, PYPY
 
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+#: Names that are always available in the dynamic scope of enaml blocks
+ENAML_SCOPE = ('self', 'change', 'nonlocals', '__scope__')
+
 
 def default_reporter():
     warnings = io.StringIO()
@@ -18,6 +35,21 @@ def default_reporter():
     return Reporter(warnings, errors)
 
 
+def check(code, filename):
+    """ Check the source and return the checker and a list of the warnings
+    followed by the errors in the format "<file>:<line>: <message>".
+    Anything that is not a python file is checked as enaml in which case
+    the checker is None.
+
+    """
+    if os.path.splitext(filename)[-1] != '.py':
+        return None, ENAML_CHECKER.check(code, filename)
+    checker, reporter = run(code, filename)
+    warnings = [l for l in reporter._stdout.getvalue().split("\n") if l]
+    errors = [l for l in reporter._stderr.getvalue().split("\n") if l]
+    return checker, warnings + errors
+
+
 def run(code, filename, reporter=None):
     """
     Check the Python source given by C{codeString} for flakes.
@@ -76,3 +108,308 @@ def run(code, filename, reporter=None):
     for warning in w.messages:
         reporter.flake(warning)
     return w, reporter
+
+
+def function_scope(body, lineno):
+    """ Wrap the statements in a function so the names they define do not
+    conflict with those of the other blocks.
+
+    """
+    func = ast.parse("def _():\n    pass\n").body[0]
+    func.body = body or func.body
+    func.lineno = lineno
+    return func
+
+
+def defined_names(stmts):
+    """ Return the names the python statements define at module level """
+    names = set()
+    for stmt in stmts:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            for alias in stmt.names:
+                names.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(stmt, (ast.FunctionDef, ast.ClassDef)):
+            names.add(stmt.name)
+        else:
+            for node in ast.walk(stmt):
+                if (isinstance(node, ast.Name) and
+                        isinstance(node.ctx, ast.Store)):
+                    names.add(node.id)
+    return names
+
+
+def used_names(tree):
+    """ Return the names the python ast loads """
+    return set(node.id for node in ast.walk(tree)
+               if isinstance(node, ast.Name) and
+               isinstance(node.ctx, ast.Load))
+
+
+class BlockVisitor(enaml_ast.ASTVisitor):
+    """ Collects the python code of an enamldef or template into a python
+    ast that pyflakes can check along with the names the block defines in
+    it's dynamic scope and the types it uses.
+
+    """
+
+    #: Statements of the python code in the block
+    statements = Value(factory=list)
+
+    #: Names of ids, attrs, and parameters in the block
+    scope = Value(factory=set)
+
+    #: Module level names used for the types in the block as (lineno, name)
+    types = Value(factory=list)
+
+    def default_visit(self, node, *args, **kwargs):
+        pass
+
+    def visit_body(self, node):
+        for item in node.body:
+            self.visit(item)
+
+    def add_type(self, node, name):
+        if name:
+            self.types.append((node.lineno, name.split('.')[0]))
+
+    def visit_EnamlDef(self, node):
+        self.add_type(node, node.base)
+        self.scope.add(node.identifier)
+        self.visit_body(node)
+
+    def visit_ChildDef(self, node):
+        self.add_type(node, node.typename)
+        self.scope.add(node.identifier)
+        self.visit_body(node)
+
+    def visit_Template(self, node):
+        params = node.parameters
+        if params is not None:
+            for p in params.positional:
+                self.scope.add(p.name)
+                self.visit(p.specialization)
+            for p in params.keywords:
+                self.scope.add(p.name)
+                self.visit(p.default)
+            self.scope.add(params.starparam)
+        self.visit_body(node)
+
+    def visit_TemplateInst(self, node):
+        self.add_type(node, node.name)
+        args = node.arguments
+        if args is not None:
+            for arg in args.args:
+                self.visit(arg)
+            self.visit(args.stararg)
+        ids = node.identifiers
+        if ids is not None:
+            self.scope.update(ids.names)
+            self.scope.add(ids.starname)
+        self.visit_body(node)
+
+    def visit_StorageExpr(self, node):
+        self.add_type(node, node.typename)
+        self.scope.add(node.name)
+        self.visit(node.expr)
+
+    def visit_ConstExpr(self, node):
+        self.add_type(node, node.typename)
+        self.scope.add(node.name)
+        self.visit(node.expr)
+
+    def visit_AliasExpr(self, node):
+        self.scope.add(node.name)
+
+    def visit_Binding(self, node):
+        self.visit(node.expr)
+
+    visit_ExBinding = visit_TemplateInstBinding = visit_Binding
+
+    def visit_OperatorExpr(self, node):
+        self.visit(node.value)
+
+    def visit_FuncDef(self, node):
+        self.statements.append(node.funcdef)
+
+    visit_AsyncFuncDef = visit_FuncDef
+
+    def visit_PythonExpression(self, node):
+        expr = ast.Expr(value=node.ast.body)
+        expr.lineno, expr.col_offset = node.lineno, 0
+        self.statements.append(expr)
+
+    def visit_PythonModule(self, node):
+        #: Notification handlers are already wrapped in a function
+        self.statements.extend(node.ast.body)
+
+
+class EnamlChecker(Atom):
+    """ Checks enaml source with pyflakes.
+
+    The source is parsed with the enaml parser and the python code of each
+    top level block is checked separately. The results are cached by a hash
+    of the source of each block so when the document changes only the blocks
+    that were edited are checked again. Names are then resolved between the
+    blocks using the names each one defines and uses.
+
+    Undefined names within enamldefs are not reported since they may be
+    members of the base types which can only be known by importing them.
+
+    """
+
+    #: Maximum number of blocks to keep
+    limit = Int(512)
+
+    #: Stats
+    hits = Int()
+    misses = Int()
+
+    #: Results by block hash in least recently used order
+    _blocks = Typed(OrderedDict, ())
+
+    _lock = Value(factory=threading.Lock)
+
+    def check(self, code, filename):
+        """ Check the source and return a list of the warnings followed by
+        the errors in the format "<file>:<line>: <message>".
+
+        """
+        try:
+            module = parse(code, filename)
+        except SyntaxError as e:
+            return ["{}:{}:{}: {}".format(filename, e.lineno,
+                                          e.offset or 0, e.msg)]
+        except Exception as e:
+            return ["{}:1: problem parsing source: {}".format(filename, e)]
+
+        #: Split the source into the lines of each block
+        lines = code.split("\n")
+        blocks = []
+        items = module.body
+        for i, item in enumerate(items):
+            start = self.block_start(item)
+            end = (self.block_start(items[i+1]) if i+1 < len(items)
+                   else len(lines)+1)
+            text = "\n".join(lines[start-1:end-1])
+            blocks.append((start, self.analyze(item, start, text)))
+
+        #: Resolve names between blocks
+        defined = set(dir(builtins)) | set(['__file__', '__name__'])
+        for start, block in blocks:
+            defined |= block['defined']
+
+        #: Names from star imports can't be known without importing them
+        star = any(block['star'] for start, block in blocks)
+
+        warnings, errors = [], []
+        for start, block in blocks:
+            others = set().union(*(b['used'] for s, b in blocks
+                                   if b is not block))
+            for lineno, col, kind, name, text in block['messages']:
+                if kind == 'UndefinedName' and (star or name in defined):
+                    continue
+                if kind == 'UnusedImport' and (
+                        name.split('.')[0] in others or
+                        name.split('.')[-1] in others or
+                        (name.endswith('*') and others - defined)):
+                    continue
+                warnings.append((start+lineno, "{}:{}: {}".format(
+                    filename, start+lineno, text)))
+            for lineno, name in block['types']:
+                if not star and name not in defined:
+                    line = lines[start+lineno-1].rstrip()
+                    errors.append((start+lineno, "{}:{}:{}: undefined name "
+                                   "{!r}".format(filename, start+lineno,
+                                                 len(line), name)))
+        return ([m for l, m in sorted(warnings)] +
+                [m for l, m in sorted(errors)])
+
+    def block_start(self, item):
+        """ Return the first line of the block including any decorators """
+        if isinstance(item, enaml_ast.PythonModule):
+            linenos = [item.lineno]
+            for stmt in item.ast.body:
+                linenos.append(stmt.lineno)
+                linenos.extend(d.lineno for d in
+                               getattr(stmt, 'decorator_list', []))
+            return min(linenos)
+        return item.lineno
+
+    def analyze(self, item, start, text):
+        """ Check the block or return the result from the last time a block
+        with the same source was checked. Line numbers in the result are
+        relative to the start of the block.
+
+        """
+        key = hashlib.sha1("{}\0{}".format(
+            type(item).__name__, text).encode('utf-8')).hexdigest()
+        with self._lock:
+            block = self._blocks.pop(key, None)
+            if block is not None:
+                self._blocks[key] = block
+                self.hits += 1
+                return block
+
+        if isinstance(item, enaml_ast.PythonModule):
+            tree = item.ast
+            scope = set()
+            types = []
+            defined = defined_names(tree.body)
+            used = set()
+        else:
+            visitor = BlockVisitor()
+            visitor.visit(item)
+            tree = ast.parse("")
+            tree.body = [function_scope(visitor.statements, item.lineno)]
+            ast.fix_missing_locations(tree)
+            scope = visitor.scope | set(ENAML_SCOPE)
+            scope.discard('')
+            types = [(lineno-start, name) for lineno, name in visitor.types
+                     if name not in scope]
+            defined = set([getattr(item, 'typename', None) or
+                           getattr(item, 'name', '')])
+            used = set(name for lineno, name in visitor.types)
+
+        checker = Checker(tree, '', builtins=scope)
+        results = []
+        for m in checker.messages:
+            if scope and isinstance(m, messages.UndefinedName):
+                continue
+            name = str(m.message_args[0]) if m.message_args else ''
+            if isinstance(m, messages.UnusedImport):
+                #: The message uses the full import name
+                name = name.split(' as ')[-1]
+            results.append((m.lineno-start, m.col, type(m).__name__, name,
+                            m.message % m.message_args))
+
+        block = {
+            'messages': results,
+            'types': types,
+            'defined': defined,
+            'used': used_names(tree) | used,
+            'star': any(isinstance(node, ast.ImportFrom) and
+                        any(alias.name == '*' for alias in node.names)
+                        for node in tree.body),
+        }
+        with self._lock:
+            self.misses += 1
+            self._blocks[key] = block
+            while len(self._blocks) > self.limit:
+                self._blocks.popitem(last=False)
+        return block
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def stats(self):
+        """ Return the stats of the cache """
+        return {
+            'entries': len(self._blocks),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+#: Checker used for all enaml documents
+ENAML_CHECKER = EnamlChecker()
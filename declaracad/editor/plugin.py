@@ -11,24 +11,22 @@ Created on Dec 10, 2015
 @author: jrm
 """
 import os
-import re
-import jedi
 import enaml
-import traceback
 from atom.api import (
-    Enum, ContainerList, Unicode, Tuple, Bool, List, Int, Instance, observe
+    Enum, ContainerList, Unicode, Tuple, Bool, List, Int, Instance, Value,
+    observe
 )
 
 from declaracad.core.api import Plugin, Model, log
 from enaml.scintilla.themes import THEMES
 from enaml.application import timed_call
-from enaml.core.enaml_compiler import EnamlCompiler
-from enaml.core.parser import parse
 from enaml.layout.api import InsertItem, InsertTab, RemoveItem
-from types import ModuleType
-from future.utils import exec_
 from glob import glob
 from . import inspection
+from .builder import ModelBuilder, format_error
+from .reconcile import reconcile
+from .worker import TaskWorker
+from .completion import CompletionService
 
 
 def EditorDockItem(*args, **kwargs):
@@ -48,6 +46,9 @@ class Document(Model):
     #: Any unsaved changes
     unsaved = Bool(True)
 
+    #: Source as it was last loaded or saved, None if it never was
+    saved_source = Value()
+
     #: Any linting errors
     errors = List()
 
@@ -65,47 +66,56 @@ class Document(Model):
         try:
             print("Loading '{}' from disk.".format(self.name))
             with open(self.name) as f:
-                return f.read()
+                source = f.read()
+            self.saved_source = source
+            return source
         except Exception as e:
             self.errors = [str(e)]
         return ""
 
     def _observe_source(self, change):
+        #: Compare with the saved copy instead of reading the file each time
+        self.unsaved = self.source != self.saved_source
         self._update_errors(change)
-        self._update_suggestions(change)
-        if change['type'] == 'update':
-            try:
-                with open(self.name) as f:
-                    self.unsaved = f.read() != self.source
-            except:
-                pass
+
+    def _get_plugin(self):
+        from declaracad.core.workbench import DeclaracadWorkbench
+        workbench = DeclaracadWorkbench.instance()
+        return workbench.get_plugin('declaracad.editor')
 
     def _update_errors(self, change):
-        """ Parse the source and try to detect any errors
+        """ Parse the source and try to detect any errors. This is done in
+        the background once the source stops changing.
          
         """
         if self.errors and change['type'] == 'create':
             #: Don't squash load errors
             return
-        checker, reporter = inspection.run(self.source, self.name)
-        warnings = [l for l in reporter._stdout.getvalue().split("\n") if l]
-        errors = [l for l in reporter._stderr.getvalue().split("\n") if l]
-
-        #: Ignore for enaml
-        #if os.path.splitext(self.name)[-1] == '.enaml':
-        #    errors = []
-
-        self.errors = warnings + errors
-        self.checker = checker
+        plugin = self._get_plugin()
+        plugin.worker.schedule('lint:{}'.format(id(self)), plugin.lint_delay,
+                               inspection.check, (self.source, self.name),
+                               self._on_linted)
+
+    def _on_linted(self, task):
+        if task.error:
+            log.warning(task.error)
+            return
+        self.checker, self.errors = task.result
 
-    def _update_suggestions(self, change):
+    def request_suggestions(self):
         """ Determine code completion suggestions for the current cursor
-        position in the document.
+        position in the document. This is called by the editor when a name
+        or `.` is typed and the `suggestions` are updated in the background.
+        
         """
-        from declaracad.core.workbench import DeclaracadWorkbench
-        workbench = DeclaracadWorkbench.instance()
-        plugin = workbench.get_plugin('declaracad.editor')
-        self.suggestions = plugin.autocomplete(self.source, self.cursor)
+        plugin = self._get_plugin()
+        plugin.worker.submit('autocomplete:{}'.format(id(self)),
+                             plugin.autocomplete, (self.source, self.cursor),
+                             self._on_suggestions)
+
+    def _on_suggestions(self, task):
+        self.suggestions = task.result or []
+        self._get_plugin().completion.record(task.duration)
 
 
 class EditorPlugin(Plugin):
@@ -123,9 +133,31 @@ class EditorPlugin(Plugin):
     sys_path = List().tag(config=True)
     _area_saves_pending = Int()
 
+    #: Builds the models in a background thread
+    builder = Instance(ModelBuilder, ())
+
+    #: Lints and autocompletes the documents in a background thread
+    worker = Instance(TaskWorker, ())
+
+    #: Time to wait for more changes before linting in ms
+    lint_delay = Int(250).tag(config=True)
+
+    #: Provides the autocomplete suggestions
+    completion = Instance(CompletionService, ())
+
     def start(self):
         """ Make sure the documents all open on startup """
         super(EditorPlugin, self).start()
+        self.builder.sys_path = self.sys_path
+        self.completion.sys_path = self.sys_path
+
+        #: Preload the modules used for autocomplete in the worker so they
+        #: are cached before the first completion. Each is a low priority
+        #: task so linting and completions are run before the next one.
+        for name in self.completion.modules:
+            self.worker.submit('autocomplete:preload:{}'.format(name),
+                               self.completion.preload, (name,),
+                               self._on_preloaded, priority=1)
         self.workbench.application.deferred_call(
             self._update_area_layout, {'type': 'manual'})
 
@@ -288,9 +320,10 @@ class EditorPlugin(Plugin):
         print("Opening '{}'".format(path))
 
         #: Otherwise open it
-        doc = Document(name=path, unsaved=False)
         with open(path) as f:
-            doc.source = f.read()
+            source = f.read()
+        doc = Document(name=path, saved_source=source)
+        doc.source = source
         self.documents.append(doc)
         self.active_document = doc
         editor = self.get_editor()
@@ -308,6 +341,7 @@ class EditorPlugin(Plugin):
             os.makedirs(file_dir)
         with open(doc.name, 'w') as f:
             f.write(doc.source)
+        doc.saved_source = doc.source
         doc.unsaved = False
 
     def save_file_as(self, event):
@@ -320,6 +354,7 @@ class EditorPlugin(Plugin):
 
         if not doc.name:
             doc.name = path
+            doc.saved_source = doc.source
             doc.unsaved = False
 
         doc_dir = os.path.dirname(path)
@@ -337,31 +372,55 @@ class EditorPlugin(Plugin):
         and update the 'compiled_view' attribute. If a compiled model
         is available and the view has a member named 'model', the model
         will be applied to the view.
+        
+        The source is compiled and the shapes are built in a background
+        thread once the changes settle. Only the finished assembly of the
+        latest generation is passed to the viewer.
     
         """
-        viewer = self.workbench.get_plugin('declaracad.viewer')
         doc = self.active_document
-        try:
-            ast = parse(doc.source, filename=doc.name)
-            code = EnamlCompiler.compile(ast, doc.name)
-            module = ModuleType('__main__')
-            module.__file__ = doc.name
-            namespace = module.__dict__
-            with enaml.imports():
-                exec_(code, namespace)
-            assembly = namespace.get('Assembly', lambda: None)()
-            viewer.parts = [assembly] if assembly else []
-        except Exception as e:
+        self.builder.schedule(doc.source, doc.name,
+                              lambda r: self._on_build_complete(doc, r))
+
+    def _on_build_complete(self, doc, request):
+        """ Update the viewer with the result of a build. This is called
+        on the main thread.
+        
+        """
+        viewer = self.workbench.get_plugin('declaracad.viewer')
+        if request.error:
             errors = doc.errors[:]
-            log.warning(traceback.format_exc())
-            tb = traceback.format_exc().strip().split("\n")
-            print(tb[-3])
-            m = re.search(r'File "(.+)", line (\d+),', tb[-3])
-            if m:
-                errors.append("{}:{}: {}".format(m.group(1), m.group(2),
-                                                tb[-1]))
+            log.warning(request.error)
+            error = format_error(doc.name, request.error)
+            if error:
+                errors.append(error)
             doc.errors = errors
             viewer.parts = []
+            self.builder.live = None
+        elif (request.reconcile and
+                self.builder.live is request.snapshot.node and
+                self.builder.live in viewer.parts):
+            self._reconcile(doc, request)
+        else:
+            assembly = request.assembly
+            viewer.parts = [assembly] if assembly else []
+            self.builder.live = assembly
+            self.builder.live_filename = doc.name
+
+    def _reconcile(self, doc, request):
+        """ Swap the values and shapes of the new assembly, which were
+        already built by the builder, into the live assembly so only the
+        shapes that changed are redisplayed. If it fails the live assembly
+        is discarded and the source is built again from scratch.
+        
+        """
+        try:
+            reconcile(request.reconciler, request.assembly)
+        except Exception as e:
+            log.warning("Could not reconcile the assembly: {}".format(e))
+            self.builder.live = None
+            self.builder.submit(doc.source, doc.name,
+                                lambda r: self._on_build_complete(doc, r))
 
     # -------------------------------------------------------------------------
     # Code inspection API
@@ -375,9 +434,18 @@ class EditorPlugin(Plugin):
         if change['type'] == 'update':
             self.sys_path = self._default_sys_path()
 
+    @observe('sys_path')
+    def _refresh_builder_path(self, change):
+        """ Let the builder know where project modules are imported from
+        so it can reload them when they change.
+        
+        """
+        self.builder.sys_path = self.sys_path
+        self.completion.sys_path = self.sys_path
+
     def autocomplete(self, source, cursor):
         """ Return a list of autocomplete suggestions for the given text.
-        Results are based on the modules loaded.
+        This is invoked from the background worker.
         
         Parameters
         ----------
@@ -390,33 +458,11 @@ class EditorPlugin(Plugin):
             result: list
                 List of autocompletion strings
         """
-        try:
-            #: Use jedi to get suggestions
-            line, column = cursor
-            script = jedi.Script(source, line+1, column,
-                                 sys_path=self.sys_path)
-
-            #: Get suggestions
-            results = []
-            for c in script.completions():
-                results.append(c.name)
-
-                #: Try to get a signature if the docstring matches
-                #: something Scintilla will use (ex "func(..." or "Class(...")
-                #: Scintilla ignores docstrings without a comma in the args
-                if c.type in ['function', 'class', 'instance']:
-                    docstring = c.docstring()
-
-                    #: Remove self arg
-                    docstring = docstring.replace("(self,", "(")
-
-                    if docstring.startswith("{}(".format(c.name)):
-                        results.append(docstring)
-                        continue
-
-            return results
-        except Exception:
-            #: Autocompletion may fail for random reasons so catch all errors
-            #: as we don't want the editor to exit because of this
-            return []
-
+        return self.completion.complete(source, cursor)
+
+    def _on_preloaded(self, task):
+        completion = self.completion
+        completion.record_preload(task.duration)
+        if completion.indexed:
+            log.debug("Autocomplete modules preloaded in {:0.2f}s".format(
+                completion.index_duration))
@@ -0,0 +1,340 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 12, 2018
+
+@author: jrm
+
+Update a live declaration tree to match a newly built one so only the parts
+of the model that changed are redisplayed.
+
+The new tree is built (and it's shapes rebuilt) in the builder thread and
+matched against a `Snapshot` of the live tree taken on the main thread. The
+main thread then only swaps the values and built shapes into the live tree.
+
+"""
+from difflib import SequenceMatcher
+from atom.api import Event
+from enaml.core.declarative import Declarative
+from enaml.core.pattern import Pattern
+from declaracad.core.api import log
+from declaracad.occ.impl.occ_scheduler import SCHEDULER
+
+
+class ReconcileError(Exception):
+    """ Raised when the trees can't be reconciled and the new tree must be
+    used instead.
+    """
+
+
+def kind(node):
+    """ Return a signature of the type of the node. Types are compared by
+    name because the enamldefs are recreated each time the source is
+    compiled, the code of the types is compared by `same_code`.
+
+    """
+    return tuple(c.__name__ for c in type(node).__mro__)
+
+
+def code_key(code):
+    """ Return a key of the code object that does not depend on where the
+    code is in the file.
+
+    """
+    consts = tuple(code_key(c) if hasattr(c, 'co_code') else repr(c)
+                   for c in code.co_consts)
+    return (code.co_code, code.co_names, code.co_varnames, consts)
+
+
+def function_key(f):
+    """ Return the key of the code of the function (or the function wrapped
+    by a method, property or enaml func) or None if it has none.
+
+    """
+    if isinstance(f, property):
+        return tuple(function_key(g) for g in (f.fget, f.fset, f.fdel))
+    f = getattr(f, '__func__', None) or getattr(f, 'im_func', None) or f
+    code = getattr(f, '__code__', None)
+    return code_key(code) if code is not None else None
+
+
+def code_signature(cls, engine):
+    """ Return a signature of the code of the class and the bound
+    expressions and handlers of the engine. If the code of any of them
+    changed the node must be replaced since only the values are copied when
+    reconciling.
+
+    """
+    classes = []
+    for c in cls.__mro__:
+        keys = []
+        for name, v in sorted(vars(c).items()):
+            key = function_key(v)
+            if key is not None:
+                keys.append((name, key))
+        classes.append((c.__name__, tuple(keys)))
+    handlers = []
+    if engine is not None:
+        for name, handler_set in engine._handlers.items():
+            for pair in handler_set.all_pairs:
+                for handler in (pair.reader, pair.writer):
+                    f = getattr(handler, 'func', None)
+                    handlers.append((name, type(handler).__name__,
+                                     f and function_key(f)))
+    return (tuple(classes), tuple(handlers))
+
+
+def same_code(live, new):
+    """ Check if the code of the snapshot of the live node and the new node
+    is the same. Classes that are the same object (ie not recompiled or
+    reloaded) are not compared.
+
+    """
+    if live.type is type(new):
+        return True
+    try:
+        return (code_signature(live.type, live.engine) ==
+                code_signature(type(new), getattr(new, '_d_engine', None)))
+    except Exception as e:
+        log.debug("Could not compare the code of {}: {}".format(new, e))
+        return False
+
+
+def declarative_children(node):
+    return [c for c in node.children if isinstance(c, Declarative)]
+
+
+def has_patterns(node):
+    """ Patterns (ex. Looper) create their children from their own
+    templates so nodes with them can only be replaced.
+
+    """
+    return any(isinstance(c, Pattern) for c in node.children)
+
+
+def is_loading(node):
+    """ Shapes still loading in the background are replaced so the result
+    of the load is not lost.
+
+    """
+    return bool(getattr(node.proxy, 'loading', False))
+
+
+def can_reconcile(live, new):
+    """ Check if the snapshot of the live node can be updated to match the
+    new one """
+    return (live is not None and new is not None and
+            live.kind == kind(new) and
+            live.members == set(new.members()) and
+            not live.patterns and not has_patterns(new) and
+            not live.loading and not is_loading(new) and
+            same_code(live, new))
+
+
+def declared_members(node):
+    """ Get the names of the declarative members that can be copied """
+    names = []
+    for name, m in node.members().items():
+        metadata = m.metadata or {}
+        if (not metadata.get('d_member') or
+                not metadata.get('d_writable', True) or
+                isinstance(m, Event)):
+            continue
+        names.append(name)
+    return names
+
+
+class Snapshot(object):
+    """ The state of a node of the live tree and it's children. This must
+    be created on the main thread, the builder only reads the snapshot so
+    it never reads the live tree while it may be changing.
+
+    """
+
+    def __init__(self, node):
+        #: The live node
+        self.node = node
+        self.kind = kind(node)
+        self.type = type(node)
+        self.engine = getattr(node, '_d_engine', None)
+        self.members = set(node.members())
+        self.patterns = has_patterns(node)
+        self.loading = is_loading(node)
+
+        #: Values of the declarative members
+        self.values = dict((name, getattr(node, name))
+                           for name in declared_members(node))
+        self.children = [Snapshot(c) for c in declarative_children(node)]
+
+
+def normalize(value):
+    """ Convert the value into something that can be compared. OCC types
+    are compared by identity so they are converted to tuples of their
+    coordinates.
+
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+    if hasattr(value, 'Location') and hasattr(value, 'XDirection'):
+        return (normalize(value.Location()), normalize(value.Direction()),
+                normalize(value.XDirection()))
+    if hasattr(value, 'Coord'):
+        try:
+            return tuple(value.Coord())
+        except TypeError:
+            pass
+    return value
+
+
+def is_equal(a, b):
+    if a is b:
+        return True
+    try:
+        return bool(normalize(a) == normalize(b))
+    except Exception:
+        return False
+
+
+class Reconciler(object):
+    """ Diffs the new tree against a snapshot of the live tree and applies
+    the changes.
+
+    The new tree must already be activated so all of it's shapes are built.
+    Matching nodes keep their proxies and get the values that changed and
+    the shapes of the new nodes, subtrees that changed structure are
+    replaced with the nodes of the new tree.
+
+    """
+
+    def __init__(self):
+        #: Live node to use for each new node
+        self.mapping = {}
+
+        #: Pairs of live snapshots and new nodes that match
+        self.pairs = []
+
+        #: Values to copy as (live, [(name, value), ...])
+        self.updates = []
+
+        #: Structural changes as (operation, parent, live, new)
+        self.changes = []
+
+    def plan(self, live, new):
+        """ Match the new tree with the snapshot of the live tree without
+        modifying either. This is done in the builder thread.
+
+        """
+        if not can_reconcile(live, new):
+            raise ReconcileError("{} and {} do not match".format(
+                live.node, new))
+        self._plan(live, new)
+
+        #: Values can refer to any node so this is done once all are mapped
+        for snapshot, node in self.pairs:
+            values = []
+            for name in declared_members(node):
+                value = self.translate(getattr(node, name))
+                if not is_equal(snapshot.values.get(name), value):
+                    values.append((name, value))
+            if values:
+                self.updates.append((snapshot.node, values))
+
+    def _plan(self, live, new):
+        self.mapping[new] = live.node
+        self.pairs.append((live, new))
+        a, b = live.children, declarative_children(new)
+        matcher = SequenceMatcher(None, [c.kind for c in a],
+                                  [kind(c) for c in b], autojunk=False)
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == 'equal':
+                for l, n in zip(a[i1:i2], b[j1:j2]):
+                    if can_reconcile(l, n):
+                        self._plan(l, n)
+                    else:
+                        self.changes.append(('replace', live.node, l.node, n))
+                continue
+            if op in ('replace', 'delete'):
+                for l in a[i1:i2]:
+                    self.changes.append(('remove', live.node, l.node, None))
+            if op in ('replace', 'insert'):
+                before = a[i2].node if i2 < len(a) else None
+                for n in b[j1:j2]:
+                    self.changes.append(('insert', live.node, before, n))
+
+    def translate(self, value):
+        """ Replace references to nodes of the new tree with the live ones
+        """
+        if isinstance(value, Declarative):
+            return self.mapping.get(value, value)
+        if isinstance(value, (list, tuple)):
+            items = [self.translate(v) for v in value]
+            return type(value)(items) if isinstance(value, tuple) else items
+        return value
+
+    def apply(self):
+        """ Apply the structural changes, copy the changed values and swap
+        in the shapes built by the builder. This is done on the main thread.
+
+        Returns
+        -------
+            proxies: list
+                The live proxies which had their shape swapped
+
+        """
+        for op, parent, live, new in self.changes:
+            if op in ('insert', 'replace'):
+                #: The new subtree is already active so it's only moved
+                parent.insert_children(live, [new])
+            if op in ('replace', 'remove'):
+                live.destroy()
+
+        #: Deactivate the proxies while copying so the values don't rebuild
+        #: the shapes on the main thread
+        updated = 0
+        for live, values in self.updates:
+            active = live.proxy_is_active
+            live.proxy_is_active = False
+            try:
+                for name, value in values:
+                    setattr(live, name, value)
+                    updated += 1
+            finally:
+                live.proxy_is_active = active
+
+        #: Children first so the parent's cache keys include theirs
+        proxies = []
+        for snapshot, new in reversed(self.pairs):
+            proxy, built = snapshot.node.proxy, new.proxy
+            if proxy is None or built is None or not hasattr(built, 'shape'):
+                continue
+            if proxy.shape is not built.shape:
+                proxy.shape = built.shape
+            if hasattr(built, 'cache_key'):
+                proxy.cache_key = built.cache_key
+            proxies.append(proxy)
+
+        log.debug("Reconciled {} nodes, {} values and {} structural "
+                  "changes".format(len(self.pairs), updated,
+                                   len(self.changes)))
+        return proxies
+
+
+def reconcile(reconciler, new):
+    """ Apply the changes planned by the builder to the live tree. Any nodes
+    of the new tree that are not moved into the live tree are destroyed.
+
+    """
+    proxies = [n.proxy for n in new.traverse()
+               if getattr(n, 'proxy', None) is not None]
+    try:
+        proxies.extend(reconciler.apply())
+    finally:
+        new.destroy()
+
+        #: The shapes are already up to date so drop the rebuilds the changes
+        #: queued on the main thread
+        SCHEDULER.discard(proxies)
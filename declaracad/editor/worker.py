@@ -0,0 +1,188 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 13, 2018
+
+@author: jrm
+"""
+import time
+import threading
+import traceback
+from collections import OrderedDict
+from atom.api import (
+    Atom, Unicode, Bool, Int, Float, Dict, Tuple, Typed, Instance, Callable,
+    Value
+)
+from enaml.application import deferred_call, timed_call
+from declaracad.core.api import log
+
+
+class Task(Atom):
+    """ A call to run in the background """
+
+    #: Tasks with the same key supersede each other
+    key = Unicode()
+
+    #: Generation of the key this task was submitted for
+    generation = Int()
+
+    #: Pending tasks with a lower priority are run first
+    priority = Int()
+
+    #: Function to call in the worker thread and it's arguments
+    function = Callable()
+    args = Tuple()
+
+    #: Called on the main thread with the finished task
+    callback = Callable()
+
+    #: Set when a newer task with the same key was submitted
+    cancelled = Bool()
+
+    #: Return value of the function
+    result = Value()
+
+    #: Formatted traceback if the function failed
+    error = Unicode()
+
+    #: Time the function took in seconds
+    duration = Float()
+
+
+class TaskWorker(Atom):
+    """ Runs short tasks (ex. linting) in a background thread so the editor
+    does not block while they run.
+
+    Tasks are grouped by a key. Scheduling a task with the same key as a
+    pending one cancels the pending one and the results of tasks that were
+    superseded while running are dropped, so only the latest result for each
+    key is ever passed to the callback.
+
+    Pending tasks are run in order of their priority then in the order they
+    were submitted, so background work (ex. preloading) submitted with a
+    higher priority value never delays the tasks the user is waiting on.
+
+    The stats are only modified from the main thread.
+
+    """
+
+    #: Latest generation of each key
+    generations = Dict()
+
+    #: Number of tasks that completed and were applied
+    completed = Int()
+
+    #: Number of tasks that were superseded and dropped
+    dropped = Int()
+
+    #: Tasks waiting to be run by key in the order they were submitted
+    _pending = Typed(OrderedDict, ())
+
+    #: Worker thread
+    _thread = Instance(threading.Thread)
+
+    #: Signals the worker when a task is pending
+    _condition = Instance(threading.Condition, ())
+
+    # -------------------------------------------------------------------------
+    # Main thread API
+    # -------------------------------------------------------------------------
+    def schedule(self, key, delay, function, args, callback):
+        """ Submit the task once the delay (in ms) expires. If another task
+        with the same key is scheduled before then this one is dropped.
+
+        Returns
+        -------
+            generation: int
+                The generation assigned to this task
+
+        """
+        generation = self._next_generation(key)
+        timed_call(delay, self._debounced, key, generation, function, args,
+                   callback)
+        return generation
+
+    def _debounced(self, key, generation, function, args, callback):
+        if generation != self.generations.get(key):
+            self.dropped += 1
+            return
+        self._submit(Task(key=key, generation=generation, function=function,
+                          args=args, callback=callback))
+
+    def submit(self, key, function, args, callback, priority=0):
+        """ Queue the task to be run by the worker as soon as the pending
+        tasks with a lower or equal priority are done.
+
+        """
+        task = Task(key=key, generation=self._next_generation(key),
+                    function=function, args=args, callback=callback,
+                    priority=priority)
+        self._submit(task)
+        return task
+
+    def cancel(self, key):
+        """ Cancel any scheduled, pending or running tasks with the key """
+        self._next_generation(key)
+        with self._condition:
+            task = self._pending.pop(key, None)
+        if task is not None:
+            task.cancelled = True
+            self.dropped += 1
+
+    def _next_generation(self, key):
+        generation = self.generations.get(key, 0)+1
+        self.generations[key] = generation
+        return generation
+
+    def _submit(self, task):
+        with self._condition:
+            old = self._pending.pop(task.key, None)
+            if old is not None:
+                old.cancelled = True
+                self.dropped += 1
+            self._pending[task.key] = task
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='declaracad-worker')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _on_finished(self, task):
+        """ Pass the result to the callback if it's still the latest """
+        if task.cancelled or (task.generation !=
+                              self.generations.get(task.key)):
+            self.dropped += 1
+            return
+        self.completed += 1
+        try:
+            task.callback(task)
+        except Exception:
+            log.error("Task {} callback failed:\n{}".format(
+                task.key, traceback.format_exc()))
+
+    # -------------------------------------------------------------------------
+    # Worker thread API
+    # -------------------------------------------------------------------------
+    def _run(self):
+        """ Worker thread loop """
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                #: The first of the pending tasks with the lowest priority
+                pending = self._pending
+                key = min(pending, key=lambda k: pending[k].priority)
+                task = pending.pop(key)
+            start = time.time()
+            try:
+                task.result = task.function(*task.args)
+            except Exception:
+                task.error = traceback.format_exc()
+            finally:
+                task.duration = time.time() - start
+            deferred_call(self._on_finished, task)
@@ -35,6 +35,18 @@ class ProxyBooleanOperation(ProxyOperation):
     
     def set_pave_filler(self, pave_filler):
         raise NotImplementedError
+
+    def set_balanced(self, balanced):
+        raise NotImplementedError
+
+    def set_engine(self, engine):
+        raise NotImplementedError
+
+    def set_parallel(self, parallel):
+        raise NotImplementedError
+
+    def set_fuzzy_value(self, value):
+        raise NotImplementedError
     
     def _do_operation(self, shape1, shape2):
         raise NotImplementedError
@@ -233,6 +245,21 @@ class BooleanOperation(Operation):
         The first shape argument of the operation.
     shape2: Shape
         The second shape argument of the operation.
+    balanced: Bool
+        Combine the shapes in a balanced tree instead of one at a time. For
+        a cut the tool shapes are fused together first and then cut from
+        the first shape once. This is much faster when there are many
+        children (ex. a pattern of holes).
+    engine: Enum
+        Either 'pairwise' to apply the operation to two shapes at a time or
+        'builder' to perform the operation on all of the shapes at once so
+        the intersections are only computed once. With the builder a Common
+        is still computed two shapes at a time.
+    parallel: Bool
+        Run the builder engine in parallel mode.
+    fuzzy_value: Float
+        Additional tolerance used by the builder engine to treat nearly
+        coincident shapes as touching.
     
     """
 
@@ -242,8 +269,21 @@ class BooleanOperation(Operation):
     
     #: Optional pave filler
     pave_filler = d_(Instance(object))#BOPAlgo_PaveFiller))
+
+    #: Combine the child shapes in a balanced tree
+    balanced = d_(Bool(False))
+
+    #: Boolean engine to use
+    engine = d_(Enum('pairwise', 'builder'))
+
+    #: Run the builder engine in parallel mode
+    parallel = d_(Bool(False))
+
+    #: Fuzzy tolerance of the builder engine
+    fuzzy_value = d_(Float(0, strict=False))
     
-    @observe('shape1', 'shape2', 'pave_filler')
+    @observe('shape1', 'shape2', 'pave_filler', 'balanced', 'engine',
+             'parallel', 'fuzzy_value')
     def _update_proxy(self, change):
         super(BooleanOperation, self)._update_proxy(change)
         
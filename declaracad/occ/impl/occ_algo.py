@@ -3,14 +3,18 @@ Created on Sep 27, 2016
 
 @author: jrm
 """
-from atom.api import Int, Dict, Instance, set_default
-from enaml.application import timed_call
+from atom.api import Int, Dict, Instance, Value, set_default
 from ..algo import (
     ProxyOperation, ProxyBooleanOperation, ProxyCommon, ProxyCut, ProxyFuse,
     ProxyFillet, ProxyChamfer, ProxyOffset, ProxyThickSolid, 
     ProxyPipe, ProxyThruSections, ProxyTransform, 
 )
 from .occ_shape import OccShape, OccDependentShape
+from OCC.BOPAlgo import (
+    BOPAlgo_BOP, BOPAlgo_PaveFiller, BOPAlgo_COMMON, BOPAlgo_CUT,
+    BOPAlgo_FUSE
+)
+from OCC.BOPCol import BOPCol_ListOfShape
 from OCC.BRepAlgoAPI import (
     BRepAlgoAPI_Fuse, BRepAlgoAPI_Common,
     BRepAlgoAPI_Cut
@@ -54,26 +58,6 @@ class OccOperation(OccDependentShape, ProxyOperation):
     perform the operation once all changes have settled because
     in general these operations are expensive.
     """
-    _update_count = Int(0)
-    
-    # -------------------------------------------------------------------------
-    # Initialization API
-    # -------------------------------------------------------------------------
-    def _queue_update(self, change):
-        """ Schedule an update to be performed in the next available cycle.
-        This should be used for expensive operations as opposed to an
-        immediate update with update_shape.
-        
-        """
-        self._update_count +=1
-        timed_call(0,self._dequeue_update,change)
-    
-    def _dequeue_update(self,change):
-        """ Only update when all changes are done """
-        self._update_count -=1
-        if self._update_count !=0:
-            return
-        self.update_shape(change)
     
     def set_direction(self, direction):
         self._queue_update({})
@@ -86,36 +70,183 @@ class OccBooleanOperation(OccOperation, ProxyBooleanOperation):
     """ Base class for a boolean shape operation. 
     
     """
+    #: Booleans are expensive so save them to disk
+    persistent = set_default(True)
 
-    
-    def create_shape(self):
-        """ Create the toolkit shape for the proxy object.
+    #: Operation type used by the builder engine
+    operation = Int()
+
+    #: Pave filler used by the last builder operation. The builder refers
+    #: to it so it must be kept alive as long as the builder is.
+    _pave_filler = Value()
+
+    def update_shape(self, change):
+        self.shape = self.cached(self.build_shape)
 
-        This method is called during the top-down pass, just before the
-        'init_shape()' method is called. This method should create the
-        toolkit widget and assign it to the 'widget' attribute.
+    def set_balanced(self, balanced):
+        self._queue_update({})
+
+    def set_engine(self, engine):
+        self._queue_update({})
+
+    def set_parallel(self, parallel):
+        self._queue_update({})
 
+    def set_fuzzy_value(self, value):
+        self._queue_update({})
+
+    def build_shape(self):
+        """ Apply the operation to shape1 and shape2 (if given) and then
+        each child in order.
+        
         """
         d = self.declaration
+        if d.engine == 'builder':
+            return self.build_all()
+        if d.balanced and not d.pave_filler:
+            return self.build_balanced()
+        shape = None
         if d.shape1 and d.shape2:
-            self.shape = self._do_operation(d.shape1, d.shape2)
-        else:
-            self.shape = None
-    
-    def update_shape(self,change):
-        self.create_shape()
+            shape = self._do_operation(d.shape1, d.shape2)
         for c in self.children():
-            if self.shape:
-                self.shape = self._do_operation(self.shape.Shape(),
-                                                c.shape.Shape())
+            if shape:
+                shape = self._do_operation(shape.Shape(),
+                                           c.get_operand().Shape())
             else:
-                self.shape = c.shape
+                shape = c.get_operand()
+        return shape
+
+    def build_balanced(self):
+        """ Apply the operation to all the shapes by combining them in pairs
+        so each operation works on shapes of a similar size.
+
+        """
+        shapes = self.get_shapes()
+        if len(shapes) < 2:
+            return self.children()[0].shape if shapes else None
+        return self._reduce(shapes, self._do_operation)
+
+    def build_all(self):
+        """ Apply the operation to the first shape and all the others at
+        once using a single pave filler so the intersections between the
+        shapes are only computed once.
+
+        """
+        d = self.declaration
+        shapes = self.get_shapes()
+        if len(shapes) < 2:
+            return self.children()[0].shape if shapes else None
+        op = self._do_builder_operation(shapes[:1], shapes[1:],
+                                        d.pave_filler)
+        return self._make_shape(op)
+
+    def _make_shape(self, op):
+        """ Wrap the result of the builder so it can be used like the
+        result of the other operations.
+
+        Returns
+        -------
+            shape: BRepBuilderAPI_Transform
+                An identity transform of the shape the builder created
+
+        """
+        return BRepBuilderAPI_Transform(op.Shape(), gp_Trsf(), False)
+
+    def _do_builder_operation(self, arguments, tools, pave_filler=None):
+        """ Perform the operation with the arguments and tools using the
+        BOPAlgo builder. If no pave filler is given one is created and
+        performed on all of the shapes.
+
+        Returns
+        -------
+            builder: BOPAlgo_BOP
+                The builder of the operation
+
+        """
+        if pave_filler is None:
+            shapes = BOPCol_ListOfShape()
+            for s in arguments+tools:
+                shapes.Append(s)
+            pave_filler = BOPAlgo_PaveFiller()
+            pave_filler.SetArguments(shapes)
+            self._configure_builder(pave_filler)
+            pave_filler.Perform()
+            if pave_filler.ErrorStatus():
+                raise RuntimeError("Failed to intersect the shapes of {} "
+                                   "(error {})".format(
+                                    self.declaration,
+                                    pave_filler.ErrorStatus()))
+        op = BOPAlgo_BOP()
+        for s in arguments:
+            op.AddArgument(s)
+        for s in tools:
+            op.AddTool(s)
+        op.SetOperation(self.operation)
+        self._configure_builder(op)
+        op.PerformWithFiller(pave_filler)
+        if op.ErrorStatus():
+            raise RuntimeError("Failed to build {} (error {})".format(
+                self.declaration, op.ErrorStatus()))
+        self._pave_filler = pave_filler
+        return op
+
+    def _configure_builder(self, algo):
+        """ Apply the engine settings of the declaration to the algo """
+        d = self.declaration
+        algo.SetRunParallel(d.parallel)
+        if d.fuzzy_value:
+            algo.SetFuzzyValue(d.fuzzy_value)
+
+    def get_shapes(self):
+        """ Collect shape1, shape2 (if given) and the child shapes """
+        d = self.declaration
+        shapes = []
+        if d.shape1 and d.shape2:
+            shapes.extend([d.shape1, d.shape2])
+        shapes.extend([c.get_operand().Shape() for c in self.children()])
+        return shapes
+
+    def _reduce(self, shapes, operation):
+        """ Apply the operation to each pair of shapes and repeat with the
+        results until only one is left.
+
+        Returns
+        -------
+            builder: BRepAlgoAPI_BooleanOperation
+                The builder of the final operation
+
+        """
+        while True:
+            ops = [operation(shapes[i], shapes[i+1])
+                   for i in range(0, len(shapes)-1, 2)]
+            if len(shapes) == 2:
+                return ops[0]
+            rest = shapes[-1:] if len(shapes) % 2 else []
+            shapes = [op.Shape() for op in ops]+rest
 
 
 class OccCommon(OccBooleanOperation, ProxyCommon):
     """ Common of all the child shapes together. """
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_algo_a_p_i___common.html')
+
+    operation = set_default(BOPAlgo_COMMON)
+
+    def build_all(self):
+        """ A common of many tools is the common with their union so each
+        shape must still be intersected with the result one at a time.
+
+        """
+        d = self.declaration
+        shapes = self.get_shapes()
+        if len(shapes) < 3:
+            return super(OccCommon, self).build_all()
+        op = None
+        for i, s in enumerate(shapes[1:]):
+            pave_filler = d.pave_filler if i == 0 else None
+            shape = op.Shape() if op else shapes[0]
+            op = self._do_builder_operation([shape], [s], pave_filler)
+        return self._make_shape(op)
     
     def _do_operation(self, shape1, shape2):
         d = self.declaration
@@ -130,6 +261,8 @@ class OccCut(OccBooleanOperation, ProxyCut):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_algo_a_p_i___cut.html')
 
+    operation = set_default(BOPAlgo_CUT)
+
     def _do_operation(self, shape1, shape2):
         d = self.declaration
         args = [shape1, shape2]
@@ -137,11 +270,25 @@ class OccCut(OccBooleanOperation, ProxyCut):
             args.append(d.pave_filler)
         return BRepAlgoAPI_Cut(*args)
 
+    def build_balanced(self):
+        """ Fuse all of the tools together first then cut them from the first
+        shape with a single operation.
+
+        """
+        shapes = self.get_shapes()
+        if len(shapes) < 3:
+            return super(OccCut, self).build_balanced()
+        tool = self._reduce(shapes[1:], BRepAlgoAPI_Fuse)
+        return self._do_operation(shapes[0], tool.Shape())
+
 
 class OccFuse(OccBooleanOperation, ProxyFuse):
     """ Fuse all the child shapes together. """
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_algo_a_p_i___fuse.html')
+
+    operation = set_default(BOPAlgo_FUSE)
+
     def _do_operation(self, shape1, shape2):
         d = self.declaration
         args = [shape1, shape2]
@@ -154,6 +301,9 @@ class OccFillet(OccOperation, ProxyFillet):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_fillet_a_p_i___make_fillet.html')
 
+    #: Save the result in the disk cache
+    persistent = set_default(True)
+
     shape_types = Dict(default={
         'rational': ChFi3d_Rational,
         'angular': ChFi3d_QuasiAngular,
@@ -168,16 +318,19 @@ class OccFillet(OccOperation, ProxyFillet):
         if not children:
             raise ValueError("Fillet must have a child shape to operate on.")
         child = children[0]
-        s = child.shape.Shape()
-        shape = BRepFilletAPI_MakeFillet(s)  #,self.shape_types[d.shape])
-        
-        edges = d.edges if d.edges else child.topology.edges()
-        for edge in edges:
-            shape.Add(d.radius, edge)
-        #if not shape.HasResult():
-        #    raise ValueError("Could not compute fillet,
-        # radius possibly too small?")
-        self.shape = shape
+
+        def make_fillet():
+            s = child.shape.Shape()
+            shape = BRepFilletAPI_MakeFillet(s)  #,self.shape_types[d.shape])
+
+            edges = d.edges if d.edges else child.topology.edges()
+            for edge in edges:
+                shape.Add(d.radius, edge)
+            #if not shape.HasResult():
+            #    raise ValueError("Could not compute fillet,
+            # radius possibly too small?")
+            return shape
+        self.shape = self.cached(make_fillet)
         
     def set_shape(self, shape):
         self._queue_update({})
@@ -193,6 +346,9 @@ class OccChamfer(OccOperation, ProxyChamfer):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_fillet_a_p_i___make_chamfer.html')
 
+    #: Save the result in the disk cache
+    persistent = set_default(True)
+
     def get_shape(self):
         """ Return shape to apply the chamfer to. """
         for child in self.children():
@@ -210,17 +366,18 @@ class OccChamfer(OccOperation, ProxyChamfer):
         
         #: Get the shape to apply the fillet to
         s = self.get_shape()
-        
-        shape = BRepFilletAPI_MakeChamfer(s.shape.Shape())
-        
-        for edge, face in self.get_edges(s):
-            args = [d.distance]
-            if d.distance2:
-                args.append(d.distance2)
-            args.extend([edge, face])
-            shape.Add(*args)
-                
-        self.shape = shape
+
+        def make_chamfer():
+            shape = BRepFilletAPI_MakeChamfer(s.shape.Shape())
+
+            for edge, face in self.get_edges(s):
+                args = [d.distance]
+                if d.distance2:
+                    args.append(d.distance2)
+                args.extend([edge, face])
+                shape.Add(*args)
+            return shape
+        self.shape = self.cached(make_chamfer)
      
     def set_distance(self, d):
         self._queue_update({})
@@ -261,16 +418,16 @@ class OccOffset(OccOperation, ProxyOffset):
         
         #: Get the shape to apply the fillet to
         s = self.get_shape()
-        
-        if isinstance(s.shape, BRepBuilderAPI_MakeWire):
-            shape = BRepOffsetAPI_MakeOffset(
-                s.shape.Wire(),
-                self.join_types[d.join_type]
-            )
-            shape.Perform(d.offset)
-            self.shape = shape
-        else:
-            self.shape = BRepOffsetAPI_MakeOffsetShape(
+
+        def make_offset():
+            if isinstance(s.shape, BRepBuilderAPI_MakeWire):
+                shape = BRepOffsetAPI_MakeOffset(
+                    s.shape.Wire(),
+                    self.join_types[d.join_type]
+                )
+                shape.Perform(d.offset)
+                return shape
+            return BRepOffsetAPI_MakeOffsetShape(
                 s.shape.Shape(),
                 d.offset,
                 d.tolerance,
@@ -279,6 +436,7 @@ class OccOffset(OccOperation, ProxyOffset):
                 False,
                 self.join_types[d.join_type]
             )
+        self.shape = self.cached(make_offset)
         
     def set_offset(self, offset):
         self._queue_update({})
@@ -317,7 +475,7 @@ class OccThickSolid(OccOffset, ProxyThickSolid):
         if faces.IsEmpty():
             return
         
-        self.shape = BRepOffsetAPI_MakeThickSolid(
+        self.shape = self.cached(lambda: BRepOffsetAPI_MakeThickSolid(
             s.shape.Shape(),
             faces,
             d.offset,
@@ -326,7 +484,7 @@ class OccThickSolid(OccOffset, ProxyThickSolid):
             d.intersection,
             False,
             self.join_types[d.join_type]
-        )
+        ))
         
     def set_closing_faces(self, faces):
         self._queue_update({})
@@ -336,6 +494,9 @@ class OccPipe(OccOperation, ProxyPipe):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_offset_a_p_i___make_pipe.html')
 
+    #: Save the result in the disk cache
+    persistent = set_default(True)
+
     #: References to observed shapes
     _old_spline = Instance(OccShape)
     _old_profile = Instance(OccShape)
@@ -360,6 +521,12 @@ class OccPipe(OccOperation, ProxyPipe):
             self.set_spline(d.spline)
         if d.profile:
             self.set_profile(d.profile)
+
+    def get_dependencies(self):
+        """ Include the spline and profile if they are not children """
+        shapes = super(OccPipe, self).get_dependencies()
+        return shapes+[s for s in (self._old_spline, self._old_profile)
+                       if s is not None]
     
     def update_shape(self, change):
         d = self.declaration
@@ -372,13 +539,10 @@ class OccPipe(OccOperation, ProxyPipe):
             i += 1
         profile = d.profile.proxy if d.profile else shapes[i]
         
+        args = [spline.shape.Wire(), profile.shape.Shape()]
         if d.fill_mode:
-            self.shape = BRepOffsetAPI_MakePipe(spline.shape.Wire(),
-                                                profile.shape.Shape(),
-                                                self.fill_modes[d.fill_mode])
-        else:
-            self.shape = BRepOffsetAPI_MakePipe(spline.shape.Wire(),
-                                                profile.shape.Shape())
+            args.append(self.fill_modes[d.fill_mode])
+        self.shape = self.cached(lambda: BRepOffsetAPI_MakePipe(*args))
     
     def set_spline(self, spline):
         #: Unobserve the old spline and observe the new one
@@ -410,26 +574,31 @@ class OccThruSections(OccOperation, ProxyThruSections):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_offset_a_p_i___thru_sections.html')
 
+    #: Save the result in the disk cache
+    persistent = set_default(True)
+
     def update_shape(self, change):
         from .occ_draw import OccVertex, OccWire
         
         d = self.declaration
-        
-        shape = BRepOffsetAPI_ThruSections(d.solid,
-                                           d.ruled,
-                                           d.precision)
-        
-        #: TODO: Support Smoothing, Max degree, par type, etc...
-        
-        for child in self.children():
-            if isinstance(child, OccVertex):
-                shape.AddVertex(child.shape.Vertex())
-            elif isinstance(child, OccWire):
-                shape.AddWire(child.shape.Wire())
-            #: TODO: Handle transform???
-        
+
+        def make_thru_sections():
+            shape = BRepOffsetAPI_ThruSections(d.solid,
+                                               d.ruled,
+                                               d.precision)
+
+            #: TODO: Support Smoothing, Max degree, par type, etc...
+
+            for child in self.children():
+                if isinstance(child, OccVertex):
+                    shape.AddVertex(child.shape.Vertex())
+                elif isinstance(child, OccWire):
+                    shape.AddWire(child.shape.Wire())
+                #: TODO: Handle transform???
+            return shape
+
         #: Set the shape
-        self.shape = shape
+        self.shape = self.cached(make_thru_sections)
         
     def set_solid(self, solid):
         self._queue_update({})
@@ -452,6 +621,13 @@ class OccTransform(OccOperation, ProxyTransform):
         if d.shape:
             #: Make sure we bind the observer
             self.set_shape(d.shape)
+
+    def get_dependencies(self):
+        """ Include the shape to transform if it's not a child """
+        shapes = super(OccTransform, self).get_dependencies()
+        if self._old_shape is not None:
+            shapes.append(self._old_shape)
+        return shapes
     
     def get_shape(self):
         """ Return shape to apply the transform to. """
@@ -505,7 +681,8 @@ class OccTransform(OccOperation, ProxyTransform):
             s = self.get_shape()
         t = self.get_transform()
         shape = s.shape.Shape() if hasattr(s.shape, 'Shape') else s.shape
-        self.shape = BRepBuilderAPI_Transform(shape, t, make_copy)
+        self.shape = self.cached(
+            lambda: BRepBuilderAPI_Transform(shape, t, make_copy))
 
     def set_shape(self, shape):
         if self._old_shape:
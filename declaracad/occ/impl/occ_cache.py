@@ -0,0 +1,424 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 3, 2018
+
+@author: jrm
+"""
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from atom.api import Atom, Bool, Int, Unicode, Typed, Value, Event
+from declaracad.core.utils import log
+
+from OCC.BRep import BRep_Builder, BRep_Tool
+from OCC.BRepGProp import (
+    brepgprop_LinearProperties, brepgprop_SurfaceProperties,
+    brepgprop_VolumeProperties
+)
+from OCC.BRepTools import breptools_Read, breptools_Write
+from OCC.GProp import GProp_GProps
+from OCC.TopAbs import (
+    TopAbs_VERTEX, TopAbs_EDGE, TopAbs_WIRE, TopAbs_FACE, TopAbs_SHELL
+)
+from OCC.TopExp import topexp_MapShapes
+from OCC.TopTools import TopTools_IndexedMapOfShape
+from OCC.TopoDS import TopoDS_Shape, topods_Vertex
+from OCC.gp import gp_Pnt, gp_Dir, gp_Vec, gp_Ax2
+
+#: Bump this when the key format or the shapes built change so old entries
+#: in the disk cache are no longer used
+CACHE_VERSION = 2
+
+#: Members that only affect how the shape is displayed
+DISPLAY_MEMBERS = set(['name', 'color', 'material', 'transparency'])
+
+#: Approximate memory used for each topological entity (in bytes)
+VERTEX_SIZE = 128
+EDGE_SIZE = 1024
+FACE_SIZE = 4096
+
+
+class Uncacheable(Exception):
+    """ Raised when a value cannot be used in a cache key """
+
+
+def shape_signature(shape):
+    """ Return a signature of the geometry of a shape that is stable across
+    sessions. It uses the position of every vertex and the length, area, or
+    volume (depending on the type) and the center of mass so shapes with
+    the same bounds (ex. a line and an arc) are different.
+
+    """
+    t = shape.ShapeType()
+    props = GProp_GProps()
+    if t in (TopAbs_EDGE, TopAbs_WIRE):
+        brepgprop_LinearProperties(shape, props)
+    elif t in (TopAbs_FACE, TopAbs_SHELL):
+        brepgprop_SurfaceProperties(shape, props)
+    elif t != TopAbs_VERTEX:
+        brepgprop_VolumeProperties(shape, props)
+    center = props.CentreOfMass()
+    vertices = TopTools_IndexedMapOfShape()
+    topexp_MapShapes(shape, TopAbs_VERTEX, vertices)
+    points = []
+    for i in range(1, vertices.Extent()+1):
+        p = BRep_Tool.Pnt(topods_Vertex(vertices.FindKey(i)))
+        points.append((round(p.X(), 6), round(p.Y(), 6), round(p.Z(), 6)))
+    return (t, shape.Orientation(), round(props.Mass(), 6),
+            (round(center.X(), 6), round(center.Y(), 6),
+             round(center.Z(), 6)), tuple(points))
+
+
+def freeze(value):
+    """ Convert a declaration value into a hashable and repr-stable value
+    that can be used to create a cache key.
+
+    Raises
+    ------
+        Uncacheable: If the value cannot be converted
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (gp_Pnt, gp_Dir, gp_Vec)):
+        return (type(value).__name__, value.X(), value.Y(), value.Z())
+    elif isinstance(value, gp_Ax2):
+        return ('gp_Ax2', freeze(value.Location()),
+                freeze(value.Direction()), freeze(value.XDirection()))
+    elif isinstance(value, TopoDS_Shape):
+        #: Use the geometry so the key is stable across sessions
+        return ('TopoDS_Shape', shape_signature(value))
+    elif hasattr(value, 'proxy'):
+        #: A shape declaration
+        key = getattr(value.proxy, 'cache_key', None)
+        if not key:
+            raise Uncacheable(value)
+        return ('Shape', key)
+    raise Uncacheable(value)
+
+
+def shape_key(proxy):
+    """ Generate a key for the shape built by the proxy from the declaration
+    type, it's parameters and the keys of the child shapes.
+
+    Returns
+    -------
+        key: str or None
+            The key or None if the shape cannot be cached
+
+    """
+    d = proxy.declaration
+    if d is None:
+        return None
+
+    #: Use the members of the shape class not any enamldef's
+    cls = type(d)
+    for base in cls.__mro__:
+        if base.__module__.startswith('declaracad.occ'):
+            cls = base
+            break
+
+    try:
+        params = []
+        for name, member in sorted(cls.members().items()):
+            if (name.startswith('_') or name in DISPLAY_MEMBERS or
+                    isinstance(member, Event) or not member.metadata or
+                    not member.metadata.get('d_member')):
+                continue
+            params.append((name, freeze(getattr(d, name))))
+
+        children = []
+        for child in proxy.children():
+            if not hasattr(child, 'cache_key'):
+                continue
+            if not child.cache_key:
+                return None
+            children.append(child.cache_key)
+    except Uncacheable:
+        return None
+
+    state = repr((CACHE_VERSION, type(proxy).__name__, cls.__name__, params,
+                  children))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def import_key(path, loader):
+    """ Generate a key for a shape imported from a file. The key changes
+    whenever the file is modified.
+
+    """
+    stat = os.stat(path)
+    state = repr((CACHE_VERSION, 'import', os.path.abspath(path),
+                  stat.st_mtime, stat.st_size, loader))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def shape_size(shape):
+    """ Estimate the memory used by the shape based on the number of
+    faces, edges, and vertices it has.
+
+    """
+    if hasattr(shape, 'Shape'):
+        shape = shape.Shape()
+    if not isinstance(shape, TopoDS_Shape) or shape.IsNull():
+        return 0
+    size = 0
+    for t, n in ((TopAbs_VERTEX, VERTEX_SIZE), (TopAbs_EDGE, EDGE_SIZE),
+                 (TopAbs_FACE, FACE_SIZE)):
+        m = TopTools_IndexedMapOfShape()
+        topexp_MapShapes(shape, t, m)
+        size += m.Extent()*n
+    return size
+
+
+class ShapeCache(Atom):
+    """ An in memory LRU cache of built shapes. Entries are evicted least
+    recently used first once the estimated size exceeds the budget.
+
+    """
+
+    #: Memory budget in bytes
+    budget = Int(256*1024*1024)
+
+    #: Estimated size of all entries in bytes
+    size = Int()
+
+    #: Cache stats
+    hits = Int()
+    misses = Int()
+    evictions = Int()
+
+    #: Entries of key -> (shape, size) in LRU order
+    _entries = Typed(OrderedDict, ())
+
+    #: Shapes are built from the builder thread and the main thread
+    _lock = Value(factory=threading.Lock)
+
+    def get(self, key):
+        """ Lookup the shape with the given key. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            #: Move to the end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, shape):
+        """ Add the shape to the cache evicting old entries if needed. """
+        n = shape_size(shape)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if n > self.budget:
+                return
+            self._entries[key] = (shape, n)
+            self.size += n
+            while self.size > self.budget:
+                k, (s, m) = self._entries.popitem(last=False)
+                self.size -= m
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return the stats of the memory cache """
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class DiskShapeCache(Atom):
+    """ A persistent cache of shapes saved as BRep files. Files are evicted
+    least recently used first (by modification time) once the total size
+    exceeds the limit.
+
+    """
+
+    #: Enable or disable the cache
+    enabled = Bool(True)
+
+    #: Directory to store the shapes
+    path = Unicode(os.path.expanduser('~/.config/declaracad/cache'))
+
+    #: Maximum size of the cache in bytes
+    limit = Int(1024*1024*1024)
+
+    #: Size of the files in the cache
+    size = Int(-1)
+
+    #: Cache stats
+    hits = Int()
+    misses = Int()
+    writes = Int()
+    evictions = Int()
+
+    _lock = Value(factory=threading.Lock)
+
+    def _filename(self, key):
+        return os.path.join(self.path, '{}.brep'.format(key))
+
+    def get(self, key):
+        """ Load the shape with the given key from disk.
+
+        Returns
+        -------
+            shape: TopoDS_Shape or None
+                The shape or None if it's not in the cache
+
+        """
+        if not self.enabled:
+            return None
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            self.misses += 1
+            return None
+        shape = TopoDS_Shape()
+        builder = BRep_Builder()
+        try:
+            with self._lock:
+                breptools_Read(shape, filename, builder)
+                #: Mark it as recently used
+                os.utime(filename, None)
+        except Exception as e:
+            log.warning("Failed to load cached shape {}: {}".format(
+                filename, e))
+            return None
+        if shape.IsNull():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return shape
+
+    def set(self, key, shape):
+        """ Save the shape to the disk cache evicting old files as needed.
+
+        """
+        if not self.enabled or shape is None or shape.IsNull():
+            return
+        filename = self._filename(key)
+        tmp = '{}.tmp'.format(filename)
+        try:
+            with self._lock:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                breptools_Write(shape, tmp)
+                self._add(tmp, filename)
+        except Exception as e:
+            log.warning("Failed to save cached shape {}: {}".format(
+                filename, e))
+
+    def add(self, key, path):
+        """ Move an existing BRep file into the cache. If the cache is
+        disabled the file is removed.
+
+        """
+        if not self.enabled:
+            os.remove(path)
+            return
+        filename = self._filename(key)
+        try:
+            with self._lock:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                shutil.move(path, filename+'.tmp')
+                self._add(filename+'.tmp', filename)
+        except Exception as e:
+            log.warning("Failed to add cached shape {}: {}".format(
+                filename, e))
+
+    def _add(self, tmp, filename):
+        """ Replace the file with the tmp file and evict old files as needed.
+        The lock must be held.
+
+        """
+        if self.size < 0:
+            self.size = sum(n for f, t, n in self._files())
+        if os.path.exists(filename):
+            self.size -= os.path.getsize(filename)
+            os.remove(filename)
+        os.rename(tmp, filename)
+        self.size += os.path.getsize(filename)
+        self.writes += 1
+        if self.size > self.limit:
+            self._evict()
+
+    def _files(self):
+        """ List the files in the cache as (filename, mtime, size) in least
+        recently used order.
+
+        """
+        if not os.path.exists(self.path):
+            return []
+        files = []
+        for f in os.listdir(self.path):
+            if not f.endswith('.brep'):
+                continue
+            f = os.path.join(self.path, f)
+            stat = os.stat(f)
+            files.append((f, stat.st_mtime, stat.st_size))
+        files.sort(key=lambda it: it[1])
+        return files
+
+    def _evict(self):
+        """ Remove files until the cache is under the limit """
+        for f, t, n in self._files():
+            if self.size <= self.limit:
+                break
+            os.remove(f)
+            self.size -= n
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for f, t, n in self._files():
+                os.remove(f)
+            self.size = 0
+
+    def stats(self):
+        """ Return the stats of the disk cache """
+        with self._lock:
+            files = self._files()
+            self.size = sum(n for f, t, n in files)
+        return {
+            'path': self.path,
+            'entries': len(files),
+            'size': self.size,
+            'limit': self.limit,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+
+#: Cache shared by all shapes
+SHAPE_CACHE = ShapeCache()
+
+#: Persistent cache of the expensive shapes
+DISK_CACHE = DiskShapeCache()
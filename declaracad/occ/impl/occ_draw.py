@@ -3,8 +3,7 @@ Created on Sep 30, 2016
 
 @author: jrm
 """
-from atom.api import Typed, Int, List, set_default
-from enaml.application import timed_call
+from atom.api import Typed, List, set_default
 
 from ..draw import (
     ProxyPoint, ProxyVertex, ProxyLine, ProxyCircle, ProxyEllipse, 
@@ -12,6 +11,7 @@ from ..draw import (
     ProxySegment, ProxyArc, ProxyPolygon,
 )
 from .occ_shape import OccShape, OccDependentShape
+from .occ_scheduler import SCHEDULER
 
 from OCC.BRepBuilderAPI import (
     BRepBuilderAPI_MakeEdge, BRepBuilderAPI_MakeWire,
@@ -261,8 +261,6 @@ class OccWire(OccShape, ProxyWire):
     reference = set_default('https://dev.opencascade.org/doc/refman/html/'
                             'class_b_rep_builder_a_p_i___make_wire.html')
 
-    _update_count = Int(0)
-    
     #: Make wire
     shape = Typed(BRepBuilderAPI_MakeWire)
     
@@ -304,14 +302,6 @@ class OccWire(OccShape, ProxyWire):
         super(OccEdge, self).child_removed(child)
         child.unobserve('shape', self._queue_update)
         
-    def _queue_update(self,change=None):
-        change = change or {}
-        self._update_count += 1
-        timed_call(0, self._dequeue_update, change)
-    
-    def _dequeue_update(self, change):
-        # Only update when all changes are done
-        self._update_count -= 1
-        if self._update_count != 0:
-            return
-        self.update_shape(change)
+    def _queue_update(self, change=None):
+        """ Update once all the edges changed in this batch are rebuilt """
+        SCHEDULER.schedule(self, self.update_shape, change)
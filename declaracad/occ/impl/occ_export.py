@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 6, 2018
+
+@author: jrm
+"""
+import os
+import json
+import base64
+import struct
+from atom.api import set_default
+
+from OCC import Quantity
+from OCC.BRep import BRep_Builder
+from OCC.BRepTools import breptools_Write
+from OCC.IFSelect import IFSelect_RetDone
+from OCC.IGESControl import IGESControl_Writer
+from OCC.STEPControl import STEPControl_Writer, STEPControl_AsIs
+from OCC.TopoDS import TopoDS_Compound
+
+from ..plugin import Exporter, ExportError, register_exporter
+from .occ_mesh import MESH_SERVICE
+from .occ_stl import export_stl, triangles
+
+#: Color used when a shape has none
+DEFAULT_COLOR = (0.8, 0.8, 0.8)
+
+
+def color_rgb(color):
+    """ Convert a color name (ex. 'red') or hex string (ex. '#ff0000') into
+    an (r, g, b) tuple of floats.
+
+    Returns
+    -------
+        color: tuple
+            The color or an empty tuple if it is not a valid color
+
+    """
+    if not color:
+        return ()
+    if color.startswith('#') and len(color) == 7:
+        try:
+            return tuple(int(color[i:i+2], 16)/255.0 for i in (1, 3, 5))
+        except ValueError:
+            return ()
+    noc = getattr(Quantity, 'Quantity_NOC_{}'.format(color.upper()), None)
+    if noc is None:
+        return ()
+    c = Quantity.Quantity_Color(noc)
+    return (c.Red(), c.Green(), c.Blue())
+
+
+def make_compound(shapes):
+    """ Make a compound of all the export shapes """
+    builder = BRep_Builder()
+    compound = TopoDS_Compound()
+    builder.MakeCompound(compound)
+    for s in shapes:
+        builder.Add(compound, s.shape)
+    return compound
+
+
+def mesh_shapes(job, start=0, stop=80):
+    """ Mesh the shapes of the job and yield each shape and it's triangles
+    while reporting the progress between start and stop.
+
+    """
+    options = job.options
+    n = len(job.shapes)
+    for i, s in enumerate(job.shapes):
+        job.update(start+(stop-start)*i/n, 'Meshing {}'.format(s.name))
+        MESH_SERVICE.mesh(s.shape, options.linear_deflection,
+                          options.angular_deflection, options.relative)
+        yield s, triangles(s.shape)
+
+
+class StlExporter(Exporter):
+    id = set_default('stl')
+    name = set_default('STL')
+    extension = set_default('.stl')
+    meshed = set_default(True)
+
+    #: Mesh each shape of the parts in parallel instead of each part
+    expand = set_default(True)
+
+    def export(self, job):
+        n = len(job.shapes)
+
+        def progress(i):
+            job.update(100.0*i/n, 'Meshed {} of {} parts'.format(i, n))
+
+        progress(0)
+        return export_stl([s.shape for s in job.shapes], job.options,
+                          [s.name for s in job.shapes], progress)
+
+
+class StepExporter(Exporter):
+    id = set_default('step')
+    name = set_default('STEP')
+    extension = set_default('.step')
+
+    def export(self, job):
+        writer = STEPControl_Writer()
+        n = len(job.shapes)
+        for i, s in enumerate(job.shapes):
+            job.update(80.0*i/n, 'Transferring {}'.format(s.name))
+            writer.Transfer(s.shape, STEPControl_AsIs)
+        job.update(80, 'Writing')
+        path = job.options.path
+        if writer.Write(path) != IFSelect_RetDone:
+            raise ExportError("Failed to write {}".format(path))
+        return [path]
+
+
+class IgesExporter(Exporter):
+    id = set_default('iges')
+    name = set_default('IGES')
+    extension = set_default('.igs')
+
+    def export(self, job):
+        writer = IGESControl_Writer()
+        n = len(job.shapes)
+        for i, s in enumerate(job.shapes):
+            job.update(80.0*i/n, 'Transferring {}'.format(s.name))
+            writer.AddShape(s.shape)
+        job.update(80, 'Writing')
+        writer.ComputeModel()
+        path = job.options.path
+        if not writer.Write(path):
+            raise ExportError("Failed to write {}".format(path))
+        return [path]
+
+
+class BRepExporter(Exporter):
+    id = set_default('brep')
+    name = set_default('BRep')
+    extension = set_default('.brep')
+
+    def export(self, job):
+        job.update(0, 'Writing')
+        path = job.options.path
+        if not breptools_Write(make_compound(job.shapes), path):
+            raise ExportError("Failed to write {}".format(path))
+        return [path]
+
+
+class ObjExporter(Exporter):
+    """ Export a Wavefront OBJ with a material for each shape's color """
+    id = set_default('obj')
+    name = set_default('OBJ')
+    extension = set_default('.obj')
+    meshed = set_default(True)
+    expand = set_default(True)
+
+    def export(self, job):
+        path = job.options.path
+        mtl = '{}.mtl'.format(os.path.splitext(path)[0])
+        #: OBJ indices start at 1
+        vertex, normal = 1, 1
+        with open(path, 'w') as f, open(mtl, 'w') as m:
+            f.write('mtllib {}\n'.format(os.path.basename(mtl)))
+            for s, data in mesh_shapes(job, 0, 100):
+                r, g, b = s.color or DEFAULT_COLOR
+                m.write('newmtl {0}\nKd {1} {2} {3}\nd {4}\n'.format(
+                    s.name, r, g, b, 1-s.transparency))
+                f.write('o {0}\nusemtl {0}\n'.format(s.name))
+                n = len(data)//12
+                for i in range(0, n*12, 12):
+                    f.write('vn {} {} {}\n'.format(*data[i:i+3]))
+                    for j in (3, 6, 9):
+                        f.write('v {} {} {}\n'.format(*data[i+j:i+j+3]))
+                for t in range(n):
+                    v = vertex+3*t
+                    f.write('f {0}//{3} {1}//{3} {2}//{3}\n'.format(
+                        v, v+1, v+2, normal+t))
+                vertex += 3*n
+                normal += n
+        return [path, mtl]
+
+
+class GltfExporter(Exporter):
+    """ Export a glTF 2.0 file with an embedded buffer and a material for
+    each shape's color.
+
+    """
+    id = set_default('gltf')
+    name = set_default('glTF')
+    extension = set_default('.gltf')
+    meshed = set_default(True)
+    expand = set_default(True)
+
+    def export(self, job):
+        buf = bytearray()
+        gltf = {
+            'asset': {'version': '2.0', 'generator': 'declaracad'},
+            'scene': 0, 'scenes': [{'nodes': []}], 'nodes': [], 'meshes': [],
+            'materials': [], 'accessors': [], 'bufferViews': [],
+            'buffers': [],
+        }
+        for s, data in mesh_shapes(job, 0, 90):
+            n = len(data)//12
+            if not n:
+                continue
+            positions, normals = [], []
+            for i in range(0, n*12, 12):
+                for j in (3, 6, 9):
+                    positions.extend(data[i+j:i+j+3])
+                    normals.extend(data[i:i+3])
+            index = len(gltf['meshes'])
+            attributes = {}
+            for attr, values in (('POSITION', positions),
+                                 ('NORMAL', normals)):
+                accessor = {
+                    'bufferView': len(gltf['bufferViews']),
+                    'componentType': 5126,  # FLOAT
+                    'count': 3*n,
+                    'type': 'VEC3',
+                }
+                if attr == 'POSITION':
+                    accessor['min'] = [min(values[k::3]) for k in range(3)]
+                    accessor['max'] = [max(values[k::3]) for k in range(3)]
+                gltf['bufferViews'].append({
+                    'buffer': 0, 'byteOffset': len(buf),
+                    'byteLength': 4*len(values), 'target': 34962,
+                })
+                attributes[attr] = len(gltf['accessors'])
+                gltf['accessors'].append(accessor)
+                buf.extend(struct.pack('<{}f'.format(len(values)), *values))
+
+            r, g, b = s.color or DEFAULT_COLOR
+            material = {
+                'name': s.name,
+                'pbrMetallicRoughness': {
+                    'baseColorFactor': [r, g, b, 1-s.transparency],
+                },
+            }
+            if s.transparency:
+                material['alphaMode'] = 'BLEND'
+            gltf['materials'].append(material)
+            gltf['meshes'].append({
+                'name': s.name,
+                'primitives': [{'attributes': attributes, 'material': index}],
+            })
+            gltf['nodes'].append({'name': s.name, 'mesh': index})
+            gltf['scenes'][0]['nodes'].append(index)
+
+        job.update(90, 'Writing')
+        gltf['buffers'].append({
+            'byteLength': len(buf),
+            'uri': 'data:application/octet-stream;base64,{}'.format(
+                base64.b64encode(bytes(buf)).decode()),
+        })
+        path = job.options.path
+        with open(path, 'w') as f:
+            json.dump(gltf, f)
+        return [path]
+
+
+def register_default_exporters():
+    for cls in (StlExporter, StepExporter, IgesExporter, BRepExporter,
+                ObjExporter, GltfExporter):
+        register_exporter(cls())
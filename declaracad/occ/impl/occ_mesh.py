@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 5, 2018
+
+@author: jrm
+"""
+import math
+import threading
+from collections import OrderedDict
+from atom.api import Atom, Bool, Int, Float, Typed, Value
+
+from OCC.BRepBndLib import brepbndlib_Add
+from OCC.BRepMesh import BRepMesh_IncrementalMesh
+from OCC.BRepTools import breptools_Triangulation
+from OCC.Bnd import Bnd_Box
+
+#: Range of the hash codes used to lookup shapes
+HASH_UPPER = 2147483647
+
+
+class MeshService(Atom):
+    """ Meshes shapes for both the display and export and records the
+    deflection each shape was meshed with so shapes that already have a fine
+    enough triangulation are not meshed again.
+
+    """
+
+    #: Mesh the faces of a shape in parallel
+    parallel = Bool(True)
+
+    #: Deflection used for the display relative to the size of the shape.
+    #: These match the defaults of the AIS drawer so it uses the triangulation
+    #: that was already created.
+    deviation_coefficient = Float(0.001)
+    deviation_angle = Float(12*math.pi/180)
+
+    #: Maximum number of shapes to keep records of
+    limit = Int(4096)
+
+    #: Stats
+    meshed = Int()
+    reused = Int()
+
+    #: Records of hash code -> (shape, linear, angular, relative) in least
+    #: recently used order
+    _entries = Typed(OrderedDict, ())
+
+    _lock = Value(factory=threading.Lock)
+
+    def display_deflection(self, shape):
+        """ Determine the deflection the viewer uses for the shape.
+
+        Returns
+        -------
+            deflection: tuple
+                The linear and angular deflection
+
+        """
+        box = Bnd_Box()
+        brepbndlib_Add(shape, box)
+        if box.IsVoid():
+            return (self.deviation_coefficient, self.deviation_angle)
+        xmin, ymin, zmin, xmax, ymax, zmax = box.Get()
+        size = max(xmax-xmin, ymax-ymin, zmax-zmin)
+        return (size*self.deviation_coefficient*4, self.deviation_angle)
+
+    def is_meshed(self, shape, linear_deflection, angular_deflection=0.5,
+                  relative=False):
+        """ Check if the shape already has a triangulation that is at least
+        as fine as the given deflection.
+
+        """
+        key = shape.HashCode(HASH_UPPER)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0].IsSame(shape):
+            s, linear, angular, rel = entry
+            if (rel == relative and linear <= linear_deflection and
+                    angular <= angular_deflection):
+                return True
+        if not relative:
+            #: It may have been meshed elsewhere or loaded with a mesh
+            return breptools_Triangulation(shape, linear_deflection)
+        return False
+
+    def mesh(self, shape, linear_deflection, angular_deflection=0.5,
+             relative=False):
+        """ Mesh the shape unless it already has an adequate triangulation.
+
+        Returns
+        -------
+            meshed: bool
+                Whether the shape was meshed
+
+        """
+        if self.is_meshed(shape, linear_deflection, angular_deflection,
+                          relative):
+            self.reused += 1
+            return False
+        mesh = BRepMesh_IncrementalMesh(shape, linear_deflection, relative,
+                                        angular_deflection, self.parallel)
+        mesh.Perform()
+        if not mesh.IsDone():
+            raise RuntimeError("Failed to create the mesh")
+        self.meshed += 1
+        key = shape.HashCode(HASH_UPPER)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (shape, linear_deflection, angular_deflection,
+                                  relative)
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Return the stats of the mesh service """
+        return {
+            'entries': len(self._entries),
+            'meshed': self.meshed,
+            'reused': self.reused,
+        }
+
+
+#: Mesh service shared by the viewer and exporters
+MESH_SERVICE = MeshService()
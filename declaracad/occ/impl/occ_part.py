@@ -28,7 +28,9 @@ class OccPart(OccDependentShape, ProxyPart):
 
         """
         builder = BRep_Builder()
-        shape = self.shape
+        #: Use a new compound so observers of the shape (ex. the viewer
+        #: and parent parts) are notified
+        shape = TopoDS_Compound()
         builder.MakeCompound(shape)
         for s in self.shapes:
             if hasattr(s.shape, 'Shape'):
@@ -36,3 +38,4 @@ class OccPart(OccDependentShape, ProxyPart):
             else:
                 builder.Add(shape, s.shape)
         self.builder = builder
+        self.shape = shape
@@ -0,0 +1,237 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 9, 2018
+
+@author: jrm
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from functools import wraps
+from atom.api import Atom, Bool, Float, Int, Unicode, Value, Typed
+from enaml.application import Application, deferred_call, timed_call
+
+from OCC.TopAbs import TopAbs_FACE, TopAbs_EDGE
+from OCC.TopExp import topexp_MapShapes
+from OCC.TopTools import TopTools_IndexedMapOfShape
+from OCC.TopoDS import TopoDS_Shape
+
+
+def declaration_path(declaration):
+    """ Return the path of the declaration in the tree using the type and
+    index of it and each of it's parents (ex. "Assembly/Part[0]/Cut[2]").
+
+    """
+    parts = []
+    node = declaration
+    while node is not None:
+        parent = node.parent
+        kind = type(node).__name__
+        if parent is None:
+            parts.append(kind)
+        else:
+            parts.append("{}[{}]".format(kind, parent.children.index(node)))
+        node = parent
+    return "/".join(reversed(parts))
+
+
+def count_shapes(shape, shape_type):
+    """ Count the unique sub shapes of the given type """
+    m = TopTools_IndexedMapOfShape()
+    topexp_MapShapes(shape, shape_type, m)
+    return m.Extent()
+
+
+class ProfileRecord(Atom):
+    """ Build timing of a single declaration """
+
+    #: Path of the declaration in the tree
+    path = Unicode()
+
+    #: Name of the declaration
+    name = Unicode()
+
+    #: Type of the declaration
+    kind = Unicode()
+
+    #: Number of times create_shape or update_shape was called
+    calls = Int()
+
+    #: Total, slowest, and last time of the calls in seconds
+    total = Float()
+    maximum = Float()
+    last = Float()
+
+    #: Complexity of the last shape built
+    faces = Int()
+    edges = Int()
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'name': self.name,
+            'kind': self.kind,
+            'calls': self.calls,
+            'total': self.total,
+            'maximum': self.maximum,
+            'last': self.last,
+            'faces': self.faces,
+            'edges': self.edges,
+        }
+
+
+class Profiler(Atom):
+    """ Records the time each proxy takes to build it's shape. """
+
+    #: Only record while enabled so it has no cost otherwise
+    enabled = Bool()
+
+    #: Maximum number of trace events to keep
+    limit = Int(100000)
+
+    #: Records by declaration path
+    records = Typed(dict, ())
+
+    #: Trace events in the Chrome trace event format
+    events = Typed(deque)
+
+    #: Incremented (at most once per interval) on the main thread when the
+    #: records change so views can update
+    updated = Int()
+
+    #: Minimum time between updates in ms
+    interval = Int(500)
+
+    #: Whether an update is scheduled
+    _update_pending = Bool()
+
+    #: Time the events are relative to
+    _start = Float(factory=time.time)
+
+    #: Proxies currently being timed (to skip calls to the super class)
+    _active = Typed(set, ())
+
+    _lock = Value(factory=threading.Lock)
+
+    def _default_events(self):
+        return deque(maxlen=self.limit)
+
+    def profiled(self, f):
+        """ Wrap a create_shape or update_shape method to record the time
+        it takes when profiling is enabled.
+
+        """
+        @wraps(f)
+        def wrapper(proxy, *args, **kwargs):
+            key = id(proxy)
+            if not self.enabled or key in self._active:
+                return f(proxy, *args, **kwargs)
+            self._active.add(key)
+            start = time.time()
+            try:
+                return f(proxy, *args, **kwargs)
+            finally:
+                duration = time.time()-start
+                self._active.discard(key)
+                self.record(proxy, f.__name__, start, duration)
+        return wrapper
+
+    def record(self, proxy, method, start, duration):
+        """ Add the timing of a call and the complexity of it's result """
+        faces = edges = 0
+        shape = proxy.shape
+        if hasattr(shape, 'Shape'):
+            try:
+                shape = shape.Shape()
+            except Exception:
+                shape = None
+        if isinstance(shape, TopoDS_Shape) and not shape.IsNull():
+            faces = count_shapes(shape, TopAbs_FACE)
+            edges = count_shapes(shape, TopAbs_EDGE)
+
+        d = proxy.declaration
+        kind = type(d).__name__ if d is not None else type(proxy).__name__
+        name = (d.name if d is not None else '') or kind
+        path = declaration_path(d) if d is not None else kind
+        with self._lock:
+            r = self.records.get(path)
+            if r is None:
+                r = self.records[path] = ProfileRecord(
+                    path=path, name=name, kind=kind)
+            r.calls += 1
+            r.total += duration
+            r.maximum = max(r.maximum, duration)
+            r.last = duration
+            r.faces = faces
+            r.edges = edges
+            self.events.append({
+                'name': name,
+                'cat': method,
+                'ph': 'X',
+                'ts': int((start-self._start)*1e6),
+                'dur': int(duration*1e6),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': {'path': path, 'kind': kind, 'faces': faces,
+                         'edges': edges},
+            })
+        self.notify()
+
+    def notify(self):
+        """ Schedule an update of the views. Records may be added from any
+        thread so the update is posted to the main thread and throttled.
+
+        """
+        with self._lock:
+            if self._update_pending:
+                return
+            self._update_pending = True
+        if Application.instance() is None:
+            self._update()
+        else:
+            deferred_call(timed_call, self.interval, self._update)
+
+    def _update(self):
+        with self._lock:
+            self._update_pending = False
+        self.updated += 1
+
+    def get_records(self, key='total', reverse=True):
+        """ Get the records sorted by the given attribute """
+        with self._lock:
+            records = list(self.records.values())
+        return sorted(records, key=lambda r: getattr(r, key), reverse=reverse)
+
+    def clear(self):
+        """ Remove all the records, this is done before each build """
+        with self._lock:
+            self.records = {}
+            self.events.clear()
+            self._start = time.time()
+        self.notify()
+
+    def export_json(self, path):
+        """ Save the records as json """
+        with open(path, 'w') as f:
+            json.dump([r.to_dict() for r in self.get_records()], f, indent=2)
+
+    def export_trace(self, path):
+        """ Save the events as a Chrome trace which can be opened with
+        chrome://tracing
+
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+#: Profiler used by all shapes
+PROFILER = Profiler()
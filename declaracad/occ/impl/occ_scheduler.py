@@ -0,0 +1,189 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 8, 2018
+
+@author: jrm
+"""
+import heapq
+import threading
+import traceback
+from atom.api import Atom, Bool, Dict, Int, Value
+from enaml.application import Application, timed_call
+from declaracad.core.utils import log
+
+
+class Batch(Atom):
+    """ The dirty nodes of a thread """
+
+    #: Dirty nodes by id with the callback and last change
+    dirty = Dict()
+
+    #: Whether a flush is scheduled
+    scheduled = Bool()
+
+    #: Whether a flush is running
+    flushing = Bool()
+
+    #: Order of the nodes in the current batch
+    ranks = Dict()
+
+    #: Heap of the dirty nodes of the current batch by rank
+    queue = Value(factory=list)
+
+
+class RecomputeScheduler(Atom):
+    """ Collects the shapes that need to be rebuilt and rebuilds them in
+    dependency order on the next cycle of the event loop.
+
+    Each node is rebuilt once per batch after all of the shapes it depends
+    on. Rebuilding a node usually marks the nodes that depend on it as dirty
+    and these are handled within the same batch.
+
+    Each thread has it's own batch. Only the batch of the main thread is
+    flushed by the event loop, other threads (ex. the model builder
+    activating a tree) must call `flush` themselves once they are done so
+    shapes are never rebuilt by one thread while another is building them.
+
+    """
+
+    #: Number of batches done
+    batches = Int()
+
+    #: Total number of rebuilds done
+    rebuilds = Int()
+
+    #: Number of nodes rebuilt in the last batch
+    last_batch = Int()
+
+    #: Batch of each thread by thread id
+    _batches = Dict()
+
+    #: Protects the batches and stats
+    _lock = Value(factory=threading.Lock)
+
+    def get_batch(self):
+        """ Get the batch of the current thread """
+        key = threading.current_thread().ident
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = Batch()
+            return batch
+
+    def is_main_thread(self):
+        app = Application.instance()
+        return app is None or app.is_main_thread()
+
+    def schedule(self, node, callback, change=None):
+        """ Mark the node as dirty so the callback is invoked once in the
+        next batch of the current thread.
+
+        Parameters
+        ----------
+            node: Atom
+                The node to rebuild. If it has a `get_dependencies` method
+                it's rebuilt after all of its dependencies, otherwise it's
+                rebuilt after every shape.
+            callback: callable
+                Invoked with the change to rebuild the node
+            change: dict
+                The last change that caused the update
+
+        """
+        batch = self.get_batch()
+        key = id(node)
+        if key not in batch.dirty and batch.flushing:
+            heapq.heappush(batch.queue, (self.rank(node, batch), key))
+        batch.dirty[key] = (node, callback, change or {})
+        if (not batch.scheduled and not batch.flushing and
+                self.is_main_thread()):
+            batch.scheduled = True
+            timed_call(0, self.flush)
+
+    def rank(self, node, batch, visiting=None):
+        """ Determine the order of the node so each node is after all of
+        it's dependencies.
+
+        """
+        key = id(node)
+        rank = batch.ranks.get(key)
+        if rank is not None:
+            return rank
+        if not hasattr(node, 'get_dependencies'):
+            rank = float('inf')
+        else:
+            #: Skip dependencies being ranked to break any cycles
+            visiting = visiting if visiting is not None else set()
+            visiting.add(key)
+            rank = 1+max([self.rank(n, batch, visiting)
+                          for n in node.get_dependencies()
+                          if id(n) not in visiting] or [-1])
+            visiting.discard(key)
+        batch.ranks[key] = rank
+        return rank
+
+    def flush(self):
+        """ Rebuild all of the dirty nodes of the current thread """
+        batch = self.get_batch()
+        batch.scheduled = False
+        batch.flushing = True
+        batch.ranks = {}
+        count = 0
+        try:
+            queue = batch.queue = [(self.rank(n, batch), k)
+                                   for k, (n, cb, c) in batch.dirty.items()]
+            heapq.heapify(queue)
+            while queue:
+                rank, key = heapq.heappop(queue)
+                if key not in batch.dirty:
+                    continue
+                node, callback, change = batch.dirty.pop(key)
+                count += 1
+                if hasattr(node, 'rebuild_count'):
+                    node.rebuild_count += 1
+                try:
+                    callback(change)
+                except Exception:
+                    log.error("Failed to rebuild {}: {}".format(
+                        node, traceback.format_exc()))
+        finally:
+            batch.flushing = False
+            batch.ranks = {}
+            batch.queue = []
+            with self._lock:
+                self.batches += 1
+                self.rebuilds += count
+                self.last_batch = count
+
+    def discard(self, nodes):
+        """ Remove the nodes from the batch of the current thread (ex. when
+        they were already rebuilt by another thread)
+
+        """
+        batch = self.get_batch()
+        for node in nodes:
+            batch.dirty.pop(id(node), None)
+
+    def clear(self):
+        """ Discard the dirty nodes of the current thread """
+        batch = self.get_batch()
+        if not batch.flushing:
+            batch.dirty = {}
+
+    def stats(self):
+        """ Return the stats of the scheduler """
+        return {
+            'batches': self.batches,
+            'rebuilds': self.rebuilds,
+            'last_batch': self.last_batch,
+            'pending': sum(len(b.dirty) for b in self._batches.values()),
+        }
+
+
+#: Scheduler shared by all shapes and the viewer
+SCHEDULER = RecomputeScheduler()
@@ -4,13 +4,24 @@ Created on Sep 30, 2016
 @author: jrm
 """
 import os
-from atom.api import Instance, Typed, Unicode, observe, set_default
+import hashlib
+import tempfile
+import traceback
+import multiprocessing
+from atom.api import (
+    Bool, Instance, Int, Tuple, Typed, Unicode, observe, set_default
+)
+from enaml.application import deferred_call
 
 from OCC.BRepBuilderAPI import (
     BRepBuilderAPI_MakeShape, BRepBuilderAPI_MakeFace, BRepBuilderAPI_Transform
 )
 
-from OCC.BRepTools import BRepTools_WireExplorer, breptools_Read
+from OCC.BRepBndLib import brepbndlib_Add
+from OCC.BRepTools import (
+    BRepTools_WireExplorer, breptools_Read, breptools_Write
+)
+from OCC.Bnd import Bnd_Box
 from OCC.TopAbs import (
     TopAbs_VERTEX, TopAbs_EDGE, TopAbs_FACE, TopAbs_WIRE,
     TopAbs_SHELL, TopAbs_SOLID, TopAbs_COMPOUND,
@@ -18,9 +29,9 @@ from OCC.TopAbs import (
 )
 from OCC.TopExp import TopExp_Explorer, topexp_MapShapesAndAncestors
 from OCC.TopTools import (
-    TopTools_ListOfShape,
     TopTools_ListIteratorOfListOfShape,
-    TopTools_IndexedDataMapOfShapeListOfShape
+    TopTools_IndexedDataMapOfShapeListOfShape,
+    TopTools_IndexedMapOfShape
 )
 from OCC.TopoDS import (
     topods, TopoDS_Wire, TopoDS_Vertex, TopoDS_Edge,
@@ -48,7 +59,12 @@ from ..shape import (
     ProxyHalfSpace, ProxyPrism, ProxySphere, ProxyWedge,
     ProxyTorus, ProxyRevol, ProxyRawShape, ProxyLoadShape
 )
-from OCC.gp import gp_Vec, gp_Ax1, gp_Ax3, gp_Trsf
+from OCC.gp import gp_Pnt, gp_Vec, gp_Ax1, gp_Ax3, gp_Trsf
+from declaracad.core.utils import log
+from .occ_scheduler import SCHEDULER
+from .occ_profiler import PROFILER
+from .occ_cache import SHAPE_CACHE, DISK_CACHE, shape_key, import_key
+from .occ_stl import read_stl, make_mesh_face, mesh_to_brep
 
 
 class WireExplorer(object):
@@ -67,9 +83,8 @@ class WireExplorer(object):
         if self.done:
             self._reinitialize()
         topologyType = topods_Edge if edges else topods_Vertex
-        seq = []
-        hashes = []  # list that stores hashes to avoid redundancy
-        occ_seq = TopTools_ListOfShape()
+        # map that stores the items in order to avoid redundancy
+        occ_map = TopTools_IndexedMapOfShape()
         while self.wire_explorer.More():
             # loop edges
             if edges:
@@ -77,18 +92,12 @@ class WireExplorer(object):
             # loop vertices
             else:
                 current_item = self.wire_explorer.CurrentVertex()
-            current_item_hash = current_item.__hash__()
-            if not current_item_hash in hashes:
-                hashes.append(current_item_hash)
-                occ_seq.Append(current_item)
+            occ_map.Add(current_item)
             self.wire_explorer.Next()
 
-        # Convert occ_seq to python list
-        occ_iterator = TopTools_ListIteratorOfListOfShape(occ_seq)
-        while occ_iterator.More():
-            topo_to_add = topologyType(occ_iterator.Value())
-            seq.append(topo_to_add)
-            occ_iterator.Next()
+        # Convert occ_map to python list
+        seq = [topologyType(occ_map.FindKey(i))
+               for i in range(1, occ_map.Extent()+1)]
         self.done = True
         return iter(seq)
 
@@ -152,6 +161,11 @@ class Topology(object):
             TopAbs_COMPSOLID: topods.CompSolid
         }
 
+        # cache of the entities of myShape and the ancestor maps so
+        # repeated queries don't explore the shape again
+        self._topo_cache = {}
+        self._ancestor_maps = {}
+
     def _loop_topo(self, topologyType, topologicalEntity=None,
                    topologyTypeToAvoid=None):
         '''
@@ -171,52 +185,48 @@ class Topology(object):
 
         assert topologyType in topoTypes.keys(), '%s not one of %s' % (
             topologyType, topoTypes.keys())
+
+        # the entities of myShape never change so only explore it once
+        if topologicalEntity is None:
+            key = (topologyType, topologyTypeToAvoid)
+            if key not in self._topo_cache:
+                self._topo_cache[key] = self._explore(
+                    topologyType, self.myShape, topologyTypeToAvoid)
+            seq = self._topo_cache[key]
+        else:
+            seq = self._explore(topologyType, topologicalEntity,
+                                topologyTypeToAvoid)
+
+        if self.ignore_orientation:
+            return list(seq)
+        else:
+            return iter(seq)
+
+    def _explore(self, topologyType, topologicalEntity,
+                 topologyTypeToAvoid=None):
+        """ Explore the entity and return a list of the unique sub shapes
+        of the given type in the order found.
+
+        """
         self.topExp = TopExp_Explorer()
-        # use self.myShape if nothing is specified
-        if topologicalEntity is None and topologyTypeToAvoid is None:
-            self.topExp.Init(self.myShape, topologyType)
-        elif topologicalEntity is None and topologyTypeToAvoid is not None:
-            self.topExp.Init(self.myShape, topologyType, topologyTypeToAvoid)
-        elif topologyTypeToAvoid is None:
+        if topologyTypeToAvoid is None:
             self.topExp.Init(topologicalEntity, topologyType)
-        elif topologyTypeToAvoid:
+        else:
             self.topExp.Init(topologicalEntity,
                              topologyType,
                              topologyTypeToAvoid)
-        seq = []
-        hashes = []  # list that stores hashes to avoid redundancy
-        occ_seq = TopTools_ListOfShape()
+        # map that stores the items in order to avoid redundancy, it's
+        # hashed and compared with IsSame so entities that share the same
+        # TShape but differ in orientation are also filtered out
+        occ_map = TopTools_IndexedMapOfShape()
         while self.topExp.More():
-            current_item = self.topExp.Current()
-            current_item_hash = current_item.__hash__()
-
-            if not current_item_hash in hashes:
-                hashes.append(current_item_hash)
-                occ_seq.Append(current_item)
-
+            occ_map.Add(self.topExp.Current())
             self.topExp.Next()
-        # Convert occ_seq to python list
-        occ_iterator = TopTools_ListIteratorOfListOfShape(occ_seq)
-        while occ_iterator.More():
-            topo_to_add = self.topoFactory[topologyType](occ_iterator.Value())
-            seq.append(topo_to_add)
-            occ_iterator.Next()
 
-        if self.ignore_orientation:
-            # filter out those entities that share the same TShape
-            # but do *not* share the same orientation
-            filter_orientation_seq = []
-            for i in seq:
-                _present = False
-                for j in filter_orientation_seq:
-                    if i.IsSame(j):
-                        _present = True
-                        break
-                if _present is False:
-                    filter_orientation_seq.append(i)
-            return filter_orientation_seq
-        else:
-            return iter(seq)
+        # Convert occ_map to python list
+        factory = self.topoFactory[topologyType]
+        return [factory(occ_map.FindKey(i))
+                for i in range(1, occ_map.Extent()+1)]
 
     def faces(self):
         """ loops over all faces """
@@ -322,9 +332,10 @@ class Topology(object):
         @param topologicalEntity:
         '''
         topo_set = set()
-        _map = TopTools_IndexedDataMapOfShapeListOfShape()
-        topexp_MapShapesAndAncestors(self.myShape, topoTypeA, topoTypeB, _map)
-        results = _map.FindFromKey(topologicalEntity)
+        # when ignoring orientation entities are compared using IsSame
+        same_map = TopTools_IndexedMapOfShape()
+        results = self._ancestor_map(topoTypeA, topoTypeB).FindFromKey(
+            topologicalEntity)
         if results.IsEmpty():
             yield None
 
@@ -337,12 +348,8 @@ class Topology(object):
             # to assure we're not returning entities several times
             if not topo_entity in topo_set:
                 if self.ignore_orientation:
-                    unique = True
-                    for i in topo_set:
-                        if i.IsSame(topo_entity):
-                            unique = False
-                            break
-                    if unique:
+                    n = same_map.Extent()
+                    if same_map.Add(topo_entity) > n:
                         yield topo_entity
                 else:
                     yield topo_entity
@@ -350,6 +357,21 @@ class Topology(object):
             topo_set.add(topo_entity)
             topology_iterator.Next()
 
+    def _ancestor_map(self, topoTypeA, topoTypeB):
+        """ Map each sub shape of type A in the shape to the list of
+        ancestors of type B. The map is created on first use and reused by
+        all later queries.
+
+        """
+        key = (topoTypeA, topoTypeB)
+        _map = self._ancestor_maps.get(key)
+        if _map is None:
+            _map = TopTools_IndexedDataMapOfShapeListOfShape()
+            topexp_MapShapesAndAncestors(self.myShape, topoTypeA, topoTypeB,
+                                         _map)
+            self._ancestor_maps[key] = _map
+        return _map
+
     def _number_shapes_ancestors(self, topoTypeA, topoTypeB, topologicalEntity):
         '''returns the number of shape ancestors
         If you want to know how many edges a faces has:
@@ -360,9 +382,8 @@ class Topology(object):
         @param topologicalEntity:
         '''
         topo_set = set()
-        _map = TopTools_IndexedDataMapOfShapeListOfShape()
-        topexp_MapShapesAndAncestors(self.myShape, topoTypeA, topoTypeB, _map)
-        results = _map.FindFromKey(topologicalEntity)
+        results = self._ancestor_map(topoTypeA, topoTypeB).FindFromKey(
+            topologicalEntity)
         if results.IsEmpty():
             return None
         topology_iterator = TopTools_ListIteratorOfListOfShape(results)
@@ -502,11 +523,37 @@ class OccShape(ProxyShape):
     #: A reference to the toolkit shape created by the proxy.
     shape = Typed(BRepBuilderAPI_MakeShape)
     
-    #: Topology explorer of the shape
+    #: Topology explorer of the shape. It's created when first used after
+    #: the shape changes.
     topology = Typed(Topology)
 
     #: Class reference url
     reference = Unicode()
+
+    #: Key of the current shape in the shape cache. This is empty if the
+    #: shape cannot be cached.
+    cache_key = Unicode()
+
+    #: Whether the shape is expensive enough to save in the disk cache
+    persistent = Bool(False)
+
+    #: Whether the shape (or a shape it depends on) is still being loaded
+    #: in the background
+    loading = Bool()
+
+    #: Number of times the shape was rebuilt by the scheduler
+    rebuild_count = Int()
+
+    def __init_subclass__(cls, **kwargs):
+        """ Time the shape building methods of every subclass so slow
+        shapes can be found with the profiler.
+        
+        """
+        super(OccShape, cls).__init_subclass__(**kwargs)
+        for name in ('create_shape', 'update_shape'):
+            f = cls.__dict__.get(name)
+            if f is not None:
+                setattr(cls, name, PROFILER.profiled(f))
     
     # -------------------------------------------------------------------------
     # Initialization API
@@ -555,19 +602,78 @@ class OccShape(ProxyShape):
         self.init_layout()
     
     def _default_topology(self):
+        if not self.shape:
+            return None
         try:
             return Topology(self.shape.Shape())
         except:
             return None
     
+    # -------------------------------------------------------------------------
+    # Cache API
+    # -------------------------------------------------------------------------
+    def cached(self, factory):
+        """ Lookup the shape for the current state of the declaration and
+        children in the shape cache. If it's not found, create it using the
+        factory and add it to the cache.
+        
+        Parameters
+        ----------
+            factory: callable
+                Called with no arguments to build the shape on a cache miss
+        
+        Returns
+        -------
+            shape: BRepBuilderAPI_MakeShape
+                The cached or newly built shape
+        """
+        key = self.cache_key = shape_key(self) or ''
+        if not key:
+            return factory()
+        shape = SHAPE_CACHE.get(key)
+        if shape is not None:
+            return shape
+
+        #: Expensive shapes are also saved to disk
+        if self.persistent:
+            s = DISK_CACHE.get(key)
+            if s is not None:
+                shape = BRepBuilderAPI_Transform(s, gp_Trsf(), False)
+                SHAPE_CACHE.set(key, shape)
+                return shape
+
+        shape = factory()
+        if shape is not None:
+            SHAPE_CACHE.set(key, shape)
+            if self.persistent:
+                try:
+                    DISK_CACHE.set(key, shape.Shape())
+                except Exception as e:
+                    log.debug("Not saving shape {} to disk: {}".format(
+                        self, e))
+        return shape
+
+    @observe('shape')
+    def update_cache_key(self, change):
+        """ Keep the key up to date for shapes that do not use the cache so
+        dependent shapes can still be cached.
+        
+        """
+        self.cache_key = shape_key(self) or ''
+
     @observe('shape')
     def update_topology(self, change):
-        if self.shape:
-            self.topology = self._default_topology()
+        """ Discard the topology of the old shape, the new one is created
+        the next time it's used.
+        
+        """
+        del self.topology
 
     @observe('shape')    
     def update_display(self, change):
-        self.parent().update_display(change)
+        parent = self.parent()
+        if parent:
+            parent.update_display(change)
         
     def set_direction(self, direction):
         self.create_shape()
@@ -578,6 +684,20 @@ class OccShape(ProxyShape):
     def parent_shape(self):
         return self.parent().shape
 
+    def get_dependencies(self):
+        """ Get the shapes this shape is built from. These are rebuilt
+        before this shape when a change affects both.
+        
+        """
+        return [c for c in self.children() if isinstance(c, OccShape)]
+
+    def get_operand(self):
+        """ Get the shape to use when this is an operand of a boolean
+        operation.
+        
+        """
+        return self.shape
+
 
 class OccDependentShape(OccShape):
     """ Shape that is dependent on another shape """
@@ -601,23 +721,62 @@ class OccDependentShape(OccShape):
         """
         for child in self.children():
             self.child_added(child)
-        self.update_shape({})
+        if not self.loading:
+            self.update_shape({})
     
     def update_shape(self, change):
         """ Must be implmented in subclasses to create the shape
             when the dependent shapes change.
         """
         raise NotImplementedError
+
+    def child_shape_changed(self, change):
+        """ Update the shape once all of the changes in this batch are done.
+        
+        """
+        self._queue_update(change)
+
+    def _queue_update(self, change):
+        """ Schedule an update to be performed once all the shapes this
+        depends on are rebuilt. This should be used for expensive
+        operations as opposed to an immediate update with update_shape.
+        
+        """
+        SCHEDULER.schedule(self, self._dequeue_update, change)
+
+    def _dequeue_update(self, change):
+        """ Update the shape unless a child is still loading, in which case
+        it's updated once the child is done.
+        
+        """
+        if not self.loading:
+            self.update_shape(change)
+
+    def update_loading(self, change=None):
+        """ Track whether any child is loading. The updates skipped while
+        it was are done once it's finished (even if the load failed).
+
+        """
+        loading = any(c.loading for c in self.children()
+                      if isinstance(c, OccShape))
+        done = self.loading and not loading
+        self.loading = loading
+        if done:
+            self._queue_update({})
         
     def child_added(self, child):
         super(OccDependentShape, self).child_added(child)
         if isinstance(child, OccShape):
-            child.observe('shape', self.update_shape)
+            child.observe('shape', self.child_shape_changed)
+            child.observe('loading', self.update_loading)
+            self.update_loading()
         
     def child_removed(self, child):
         super(OccDependentShape, self).child_removed(child)
         if isinstance(child, OccShape):
-            child.unobserve('shape', self.update_shape)
+            child.unobserve('shape', self.child_shape_changed)
+            child.unobserve('loading', self.update_loading)
+            self.update_loading()
             
     def set_direction(self, direction):
         self.update_shape({})
@@ -646,7 +805,8 @@ class OccBox(OccShape, ProxyBox):
 
     def create_shape(self):
         d = self.declaration
-        self.shape = BRepPrimAPI_MakeBox(d.axis, d.dx, d.dy, d.dz)#.Shape()
+        self.shape = self.cached(
+            lambda: BRepPrimAPI_MakeBox(d.axis, d.dx, d.dy, d.dz))
 
     def set_dx(self, dx):
         self.create_shape()
@@ -667,7 +827,7 @@ class OccCone(OccShape, ProxyCone):
         args = [d.axis, d.radius, d.radius2, d.height]
         if d.angle:
             args.append(d.angle)
-        self.shape = BRepPrimAPI_MakeCone(*args)
+        self.shape = self.cached(lambda: BRepPrimAPI_MakeCone(*args))
 
     def set_radius(self, r):
         self.create_shape()
@@ -691,7 +851,7 @@ class OccCylinder(OccShape, ProxyCylinder):
         args = [d.axis, d.radius, d.height]
         if d.angle:
             args.append(d.angle)
-        self.shape = BRepPrimAPI_MakeCylinder(*args)
+        self.shape = self.cached(lambda: BRepPrimAPI_MakeCylinder(*args))
 
     def set_radius(self, r):
         self.create_shape()
@@ -727,19 +887,20 @@ class OccPrism(OccDependentShape, ProxyPrism):
         else:
             c = self.get_shape()
         
-        if d.infinite:
-            self.shape = BRepPrimAPI_MakePrism(
-                c.shape.Shape(),
-                d.direction,
-                True,
-                d.copy,
-                d.canonize)
-        else:
-            self.shape = BRepPrimAPI_MakePrism(
+        def make_prism():
+            if d.infinite:
+                return BRepPrimAPI_MakePrism(
+                    c.shape.Shape(),
+                    d.direction,
+                    True,
+                    d.copy,
+                    d.canonize)
+            return BRepPrimAPI_MakePrism(
                 c.shape.Shape(),
                 gp_Vec(*d.vector),
                 d.copy,
                 d.canonize)
+        self.shape = self.cached(make_prism)
 
     def get_shape(self):
         for child in self.children():
@@ -779,7 +940,7 @@ class OccSphere(OccShape, ProxySphere):
                 args.append(d.angle2)
                 if d.angle3:
                     args.append(d.angle3)
-        self.shape = BRepPrimAPI_MakeSphere(*args)
+        self.shape = self.cached(lambda: BRepPrimAPI_MakeSphere(*args))
         
     def set_radius(self, r):
         self.create_shape()
@@ -807,7 +968,7 @@ class OccTorus(OccShape, ProxyTorus):
             args.append(d.angle)
             if d.angle2:
                 args.append(d.angle2)
-        self.shape = BRepPrimAPI_MakeTorus(*args)
+        self.shape = self.cached(lambda: BRepPrimAPI_MakeTorus(*args))
         
     def set_radius(self, r):
         self.create_shape()
@@ -829,7 +990,8 @@ class OccWedge(OccShape, ProxyWedge):
     
     def create_shape(self):
         d = self.declaration
-        self.shape = BRepPrimAPI_MakeWedge(d.axis, d.dx, d.dy, d.dz, d.itx)
+        self.shape = self.cached(
+            lambda: BRepPrimAPI_MakeWedge(d.axis, d.dx, d.dy, d.dz, d.itx))
 
     def set_dx(self, dx):
         self.create_shape()
@@ -861,7 +1023,7 @@ class OccRevol(OccDependentShape, ProxyRevol):
             args.append(d.angle)
         args.append(d.copy)
         
-        self.shape = BRepPrimAPI_MakeRevol(*args)
+        self.shape = self.cached(lambda: BRepPrimAPI_MakeRevol(*args))
     
     def get_shape(self):
         """ Get the first child shape """
@@ -894,6 +1056,14 @@ class OccRawShape(OccShape, ProxyRawShape):
         """ Delegate shape creation to the declaration implementation. """
         self.shape = self.declaration.create_shape(self.parent_shape())
 
+    @observe('shape')
+    def update_cache_key(self, change):
+        """ The shape is created by user code that may depend on anything
+        so it (and any shape using it) is never cached.
+        
+        """
+        self.cache_key = ''
+
     # -------------------------------------------------------------------------
     # ProxyRawShape API
     # -------------------------------------------------------------------------
@@ -911,12 +1081,73 @@ class OccLoadShape(OccShape, ProxyLoadShape):
     #: The shape created
     shape = Instance(BRepBuilderAPI_Transform)
 
+    #: Bounding box of the last shape imported (before it's transformed)
+    _bounds = Tuple()
+
+    #: Key of the import running in the background
+    _import_key = Unicode()
+
+    #: Key of the import the current shape is from
+    _source_key = Unicode()
+
     def create_shape(self):
         """ Create the shape by loading it from the given path. """
-        shape = self.load_shape()
+        d = self.declaration
+        self._import_key = ''
+        name, key = self.get_import_key()
+        shape = self.load_cached(name, key)
+        if shape is None:
+            #: Meshes are read quickly so they are never loaded in the
+            #: background. Worker processes (ex. of a batch build) are not
+            #: allowed to start the import pool.
+            if (d.asynchronous and name != 'mesh' and
+                    not multiprocessing.current_process().daemon):
+                self.load_async(name, key)
+                return
+            shape = self.load_file(name, key)
+        self.set_imported_shape(shape, key)
+
+    def set_imported_shape(self, shape, key):
+        """ Transform the imported shape and use it as the shape """
+        box = Bnd_Box()
+        brepbndlib_Add(shape, box)
+        if not box.IsVoid():
+            self._bounds = box.Get()
         t = self.get_transform()
+        self._source_key = key
+        self.declaration.error = ''
+        self.loading = False
         self.shape = BRepBuilderAPI_Transform(shape, t, False)
 
+    @observe('shape')
+    def update_cache_key(self, change):
+        """ Include the file in the key so shapes using this are rebuilt
+        when the file changes. Placeholders are never cached.
+        
+        """
+        key = shape_key(self)
+        if self.loading or not key:
+            self.cache_key = ''
+            return
+        state = '{}{}'.format(key, self._source_key)
+        self.cache_key = hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+    def get_placeholder(self):
+        """ Create a box the size of the last shape imported (or a unit box)
+        to display while the import is running.
+
+        """
+        if self._bounds:
+            xmin, ymin, zmin, xmax, ymax, zmax = self._bounds
+        else:
+            xmin, ymin, zmin, xmax, ymax, zmax = (0, 0, 0, 1, 1, 1)
+        #: Flat shapes still need a box with some volume
+        xmax, ymax, zmax = (max(xmax, xmin+1e-3), max(ymax, ymin+1e-3),
+                            max(zmax, zmin+1e-3))
+        box = BRepPrimAPI_MakeBox(gp_Pnt(xmin, ymin, zmin),
+                                  gp_Pnt(xmax, ymax, zmax)).Shape()
+        return BRepBuilderAPI_Transform(box, self.get_transform(), False)
+
     def get_transform(self):
         d = self.declaration
         t = gp_Trsf()
@@ -924,15 +1155,103 @@ class OccLoadShape(OccShape, ProxyLoadShape):
         t.SetTransformation(gp_Ax3(d.axis))#gp_Vec(p.X(), p.Y(), p.Z()))
         return t
 
-    def load_shape(self):
+    def get_import_key(self):
+        """ Determine the loader to use and the cache key of the import.
+
+        Returns
+        -------
+            result: tuple
+                The loader name and the key
+
+        """
         d = self.declaration
         if not os.path.exists(d.path):
             raise ValueError("Can't load shape from `{}`, "
                              "the path does not exist".format(d.path))
         path, ext = os.path.splitext(d.path)
-        name = ext[1:] if d.loader == 'auto' else d.loader
-        loader = getattr(self, 'load_{}'.format(name.lower()))
-        return loader(d.path)
+        name = (ext[1:] if d.loader == 'auto' else d.loader).lower()
+        if not hasattr(self, 'load_{}'.format(name)):
+            raise ValueError("No loader for `{}`".format(d.path))
+        return name, import_key(d.path, name)
+
+    def load_cached(self, name, key):
+        """ Lookup a previous import of the file in the memory and disk
+        caches.
+
+        """
+        #: Reuse the translated shape until the file changes
+        shape = SHAPE_CACHE.get(key)
+        if shape is not None:
+            return shape
+
+        #: Translated shapes are also saved to disk as BRep which is much
+        #: faster to read than the original file
+        if name not in ('brep', 'mesh'):
+            shape = DISK_CACHE.get(key)
+            if shape is not None:
+                SHAPE_CACHE.set(key, shape)
+        return shape
+
+    def load_file(self, name, key):
+        """ Import the file with the given loader and cache the result """
+        loader = getattr(self, 'load_{}'.format(name))
+        shape = loader(self.declaration.path)
+        if name not in ('brep', 'mesh'):
+            DISK_CACHE.set(key, shape)
+        SHAPE_CACHE.set(key, shape)
+        return shape
+
+    def load_shape(self):
+        """ Load the shape from the cache or import it """
+        name, key = self.get_import_key()
+        shape = self.load_cached(name, key)
+        if shape is None:
+            shape = self.load_file(name, key)
+        return shape
+
+    def load_async(self, name, key):
+        """ Import the file in a worker process and display a placeholder
+        until it's done.
+
+        """
+        d = self.declaration
+        fd, filename = tempfile.mkstemp(prefix='declaracad-', suffix='.brep')
+        os.close(fd)
+        self._import_key = key
+        self.loading = True
+        self.shape = self.get_placeholder()
+
+        def on_done(error):
+            deferred_call(self._on_imported, name, key, filename, error)
+
+        def on_error(e):
+            #: The worker crashed or the args could not be pickled
+            on_done('{}: {}'.format(type(e).__name__, e))
+
+        import_pool().apply_async(import_file, ((d.path, name, filename),),
+                                  callback=on_done, error_callback=on_error)
+
+    def _on_imported(self, name, key, filename, error):
+        """ Swap in the imported shape if the import is still current """
+        if self.declaration is None or key != self._import_key:
+            remove_file(filename)
+            return
+        self._import_key = ''
+        if error:
+            remove_file(filename)
+            log.error("Failed to import {}: {}".format(
+                self.declaration.path, error))
+            #: Let dependent shapes build with the placeholder
+            self.declaration.error = error
+            self.loading = False
+            return
+        shape = self.load_brep(filename)
+        if name != 'brep':
+            DISK_CACHE.add(key, filename)
+        else:
+            os.remove(filename)
+        SHAPE_CACHE.set(key, shape)
+        self.set_imported_shape(shape, key)
 
     def load_brep(self, path):
         """ Load a brep model """
@@ -974,6 +1293,31 @@ class OccLoadShape(OccShape, ProxyLoadShape):
         reader.Read(shape, path)
         return shape
 
+    def load_mesh(self, path):
+        """ Load a stl model as a single face with the triangulation """
+        return make_mesh_face(*read_stl(path))
+
+    def get_operand(self):
+        """ Meshes must be converted to a BRep to be used in a boolean
+        operation. The conversion is cached as it's slow.
+        
+        """
+        d = self.declaration
+        if d.loader != 'mesh':
+            return self.shape
+        if not d.convert:
+            raise ValueError("The mesh `{}` must be converted to be used in "
+                             "an operation, set `convert = True`".format(
+                                d.path))
+        key = self.cache_key and '{}:brep'.format(self.cache_key)
+        shape = SHAPE_CACHE.get(key) if key else None
+        if shape is None:
+            shape = BRepBuilderAPI_Transform(
+                mesh_to_brep(self.shape.Shape()), gp_Trsf(), False)
+            if key:
+                SHAPE_CACHE.set(key, shape)
+        return shape
+
     # -------------------------------------------------------------------------
     # ProxyLoadShape API
     # -------------------------------------------------------------------------
@@ -982,3 +1326,48 @@ class OccLoadShape(OccShape, ProxyLoadShape):
 
     def set_loader(self, loader):
         self.create_shape()
+
+    def set_asynchronous(self, asynchronous):
+        self.create_shape()
+
+    def set_convert(self, convert):
+        self.create_shape()
+
+
+def import_file(args):
+    """ Import the file and save it as BRep so it can be passed back. This
+    is run in a worker process.
+
+    Returns
+    -------
+        error: str
+            The traceback if the import failed or an empty string
+
+    """
+    path, loader, filename = args
+    try:
+        shape = getattr(OccLoadShape(), 'load_{}'.format(loader))(path)
+        breptools_Write(shape, filename)
+    except Exception:
+        return traceback.format_exc()
+    return ''
+
+
+def remove_file(filename):
+    """ Remove the file if it exists """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+#: Worker processes used to import shapes in the background
+_IMPORT_POOL = None
+
+
+def import_pool():
+    """ Get the pool used to import shapes creating it if needed """
+    global _IMPORT_POOL
+    if _IMPORT_POOL is None:
+        _IMPORT_POOL = multiprocessing.Pool()
+    return _IMPORT_POOL
@@ -0,0 +1,323 @@
+"""
+Copyright (c) 2018, Jairus Martin.
+
+Distributed under the terms of the GPL v3 License.
+
+The full license is in the file LICENSE, distributed with this software.
+
+Created on Jan 5, 2018
+
+@author: jrm
+"""
+import os
+import math
+import struct
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from array import array
+from atom.api import Atom, Bool, Int, Unicode, Value
+
+from OCC.BRep import BRep_Builder, BRep_Tool
+from OCC.BRepBuilderAPI import (
+    BRepBuilderAPI_MakePolygon, BRepBuilderAPI_MakeFace,
+    BRepBuilderAPI_MakeSolid, BRepBuilderAPI_Sewing
+)
+from OCC.BRepTools import breptools_Read, breptools_Write
+from OCC.Poly import Poly_Array1OfTriangle, Poly_Triangle, Poly_Triangulation
+from OCC.TColgp import TColgp_Array1OfPnt
+from OCC.TopAbs import TopAbs_FACE, TopAbs_REVERSED, TopAbs_SHELL
+from OCC.TopExp import TopExp_Explorer
+from OCC.TopLoc import TopLoc_Location
+from OCC.TopoDS import TopoDS_Face, TopoDS_Shape, topods
+from OCC.gp import gp_Pnt
+
+from .occ_mesh import MESH_SERVICE
+
+
+def normal(v1, v2, v3):
+    """ Compute the unit normal of the triangle from it's vertices """
+    ax, ay, az = v2[0]-v1[0], v2[1]-v1[1], v2[2]-v1[2]
+    bx, by, bz = v3[0]-v1[0], v3[1]-v1[1], v3[2]-v1[2]
+    nx, ny, nz = ay*bz-az*by, az*bx-ax*bz, ax*by-ay*bx
+    n = math.sqrt(nx*nx+ny*ny+nz*nz)
+    if n == 0:
+        return 0.0, 0.0, 0.0
+    return nx/n, ny/n, nz/n
+
+
+def triangles(shape):
+    """ Collect the triangles of each face of a meshed shape.
+
+    Returns
+    -------
+        triangles: array
+            Flat array of floats where each triangle is 12 values, the normal
+            followed by the three vertices.
+
+    """
+    result = array('f')
+    explorer = TopExp_Explorer(shape, TopAbs_FACE)
+    while explorer.More():
+        face = topods.Face(explorer.Current())
+        explorer.Next()
+        loc = TopLoc_Location()
+        handle = BRep_Tool.Triangulation(face, loc)
+        if handle.IsNull():
+            continue
+        mesh = handle.GetObject()
+        trsf = loc.Transformation()
+        nodes = mesh.Nodes()
+        points = [nodes.Value(i).Transformed(trsf).Coord()
+                  for i in range(1, mesh.NbNodes()+1)]
+        reversed_ = face.Orientation() == TopAbs_REVERSED
+        tris = mesh.Triangles()
+        for i in range(1, mesh.NbTriangles()+1):
+            n1, n2, n3 = tris.Value(i).Get()
+            if reversed_:
+                n2, n3 = n3, n2
+            v1, v2, v3 = points[n1-1], points[n2-1], points[n3-1]
+            result.extend(normal(v1, v2, v3))
+            result.extend(v1)
+            result.extend(v2)
+            result.extend(v3)
+    return result
+
+
+def mesh_file(args):
+    """ Load a shape saved as a BRep file then mesh it unless the saved
+    triangulation is already adequate. This is run in a worker process.
+
+    Returns
+    -------
+        triangles: array
+            The triangles of the shape as returned by `triangles`
+
+    """
+    path, linear_deflection, relative, angular_deflection, meshed = args
+    shape = TopoDS_Shape()
+    breptools_Read(shape, path, BRep_Builder())
+    if not meshed:
+        MESH_SERVICE.mesh(shape, linear_deflection, angular_deflection,
+                          relative)
+    return triangles(shape)
+
+
+def read_stl(path):
+    """ Read a binary or ascii STL file using numpy.
+
+    Returns
+    -------
+        result: tuple
+            A (n, 3) array of the vertices and a (m, 3) array of the vertex
+            indices of each triangle
+
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(84)
+    n = struct.unpack('<I', header[80:84])[0] if len(header) == 84 else 0
+    if size == 84+50*n:
+        dtype = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)),
+                          ('attr', '<u2')])
+        data = np.fromfile(path, dtype=dtype, offset=84, count=n)
+        vertices = data['vertices'].reshape(-1, 3)
+    else:
+        with open(path) as f:
+            vertices = np.array([line.split()[1:4] for line in f
+                                 if line.lstrip().startswith('vertex')],
+                                dtype=np.float64).reshape(-1, 3)
+    return vertices, np.arange(len(vertices)).reshape(-1, 3)
+
+
+def make_mesh_face(vertices, indices):
+    """ Create a face that has only a triangulation (no surface) from the
+    vertices and triangle indices. This is much lighter than a face for each
+    triangle and is displayed and exported using the triangulation.
+
+    """
+    #: Each vertex is shared by several triangles (usually 6) so merge them
+    #: before creating the nodes
+    vertices, inverse = np.unique(np.asarray(vertices), axis=0,
+                                  return_inverse=True)
+    indices = inverse.reshape(-1)[np.asarray(indices)]
+
+    #: Drop triangles that became degenerate
+    indices = indices[(indices[:, 0] != indices[:, 1]) &
+                      (indices[:, 1] != indices[:, 2]) &
+                      (indices[:, 0] != indices[:, 2])]
+    nodes = TColgp_Array1OfPnt(1, len(vertices))
+    for i, (x, y, z) in enumerate(vertices.tolist()):
+        nodes.SetValue(i+1, gp_Pnt(x, y, z))
+    tris = Poly_Array1OfTriangle(1, len(indices))
+    for i, (a, b, c) in enumerate(indices.tolist()):
+        tris.SetValue(i+1, Poly_Triangle(a+1, b+1, c+1))
+    triangulation = Poly_Triangulation(nodes, tris)
+    face = TopoDS_Face()
+    BRep_Builder().MakeFace(face, triangulation.GetHandle())
+    return face
+
+
+def mesh_to_brep(shape, tolerance=1e-6):
+    """ Convert the triangulation of the shape into a BRep with a planar face
+    for each triangle sewn into a shell (or solid if it's closed). This can
+    be very slow for large meshes.
+
+    """
+    sewing = BRepBuilderAPI_Sewing(tolerance)
+    data = triangles(shape)
+    for i in range(0, len(data), 12):
+        polygon = BRepBuilderAPI_MakePolygon(
+            gp_Pnt(*data[i+3:i+6]), gp_Pnt(*data[i+6:i+9]),
+            gp_Pnt(*data[i+9:i+12]), True)
+        if polygon.IsDone():
+            sewing.Add(BRepBuilderAPI_MakeFace(polygon.Wire()).Face())
+    sewing.Perform()
+    result = sewing.SewedShape()
+    if result.ShapeType() == TopAbs_SHELL and result.Closed():
+        solid = BRepBuilderAPI_MakeSolid(topods.Shell(result))
+        if solid.IsDone():
+            return solid.Shape()
+    return result
+
+
+class StlWriter(Atom):
+    """ Writes triangles to an STL file as they are added so the whole model
+    never needs to be in memory.
+
+    """
+
+    #: Path to write
+    path = Unicode()
+
+    #: Write a binary (or ascii) file
+    binary = Bool(True)
+
+    #: Name of the solid
+    name = Unicode('declaracad')
+
+    #: Number of triangles written
+    count = Int()
+
+    #: File being written
+    _file = Value()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.count = 0
+        if self.binary:
+            self._file = open(self.path, 'wb')
+            self._file.write(struct.pack('<80sI', self.name.encode(), 0))
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write('solid {}\n'.format(self.name))
+
+    def write(self, data):
+        """ Write the triangles in the format returned by `triangles`. """
+        n = len(data)//12
+        f = self._file
+        if self.binary:
+            #: Each record is followed by a 2 byte attribute count of 0
+            record = struct.Struct('<12f2x')
+            for i in range(0, n*12, 12):
+                f.write(record.pack(*data[i:i+12]))
+        else:
+            for i in range(0, n*12, 12):
+                f.write('facet normal {} {} {}\n outer loop\n'
+                        '  vertex {} {} {}\n  vertex {} {} {}\n'
+                        '  vertex {} {} {}\n endloop\nendfacet\n'.format(
+                            *data[i:i+12]))
+        self.count += n
+
+    def close(self):
+        f = self._file
+        if f is None:
+            return
+        if self.binary:
+            #: Update the triangle count in the header
+            f.seek(80)
+            f.write(struct.pack('<I', self.count))
+        else:
+            f.write('endsolid {}\n'.format(self.name))
+        f.close()
+        self._file = None
+
+
+def export_stl(shapes, options, names=None, progress=None):
+    """ Mesh each shape in a pool of worker processes and write the triangles
+    to STL as each shape is done.
+
+    Parameters
+    ----------
+        shapes: List of TopoDS_Shape
+            Shapes to export
+        options: ExportOptions
+            Export options
+        names: List of str
+            Names used for the files when exporting one file per shape
+        progress: callable
+            Called with the number of shapes written after each is done
+
+    Returns
+    -------
+        paths: List of str
+            The files written
+
+    """
+    base, ext = os.path.splitext(options.path)
+    if options.split:
+        if names is None:
+            names = ['part{}'.format(i) for i in range(len(shapes))]
+        paths = ['{}-{}{}'.format(base, n, ext or '.stl') for n in names]
+    else:
+        paths = [options.path]
+
+    #: Shapes can't be pickled so pass them to the workers as BRep files.
+    #: The files include the triangulation so shapes already meshed by the
+    #: viewer (or a previous export) do not need to be meshed again.
+    tmp = tempfile.mkdtemp(prefix='declaracad-')
+    try:
+        args = []
+        for i, shape in enumerate(shapes):
+            path = os.path.join(tmp, '{}.brep'.format(i))
+            breptools_Write(shape, path)
+            meshed = MESH_SERVICE.is_meshed(
+                shape, options.linear_deflection, options.angular_deflection,
+                options.relative)
+            args.append((path, options.linear_deflection, options.relative,
+                         options.angular_deflection, meshed))
+
+        jobs = min(options.jobs or multiprocessing.cpu_count(), len(args))
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap(mesh_file, args)
+        else:
+            pool = None
+            results = (mesh_file(a) for a in args)
+
+        try:
+            if options.split:
+                for i, (path, data) in enumerate(zip(paths, results)):
+                    with StlWriter(path=path, binary=options.binary) as w:
+                        w.write(data)
+                    if progress:
+                        progress(i+1)
+            else:
+                with StlWriter(path=paths[0], binary=options.binary) as w:
+                    for i, data in enumerate(results):
+                        w.write(data)
+                        if progress:
+                            progress(i+1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return paths
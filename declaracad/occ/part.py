@@ -16,7 +16,9 @@ class ProxyPart(ProxyShape):
     declaration = ForwardTyped(lambda: Part)
     
     def update_display(self, change):
-        self.parent().update_display(change)
+        parent = self.parent()
+        if parent:
+            parent.update_display(change)
 
     
 class Part(Shape):
@@ -11,30 +11,212 @@ Created on Dec 13, 2017
 @author: jrm
 """
 import os
-from atom.api import List, Unicode, Float, Bool
-from declaracad.core.api import Plugin, Model
-from enaml.application import timed_call
+import re
+import threading
+import traceback
+from collections import OrderedDict
+from atom.api import (
+    Atom, List, Unicode, Float, Bool, Int, Tuple, Value, Instance, observe
+)
+from declaracad.core.api import Plugin, Model, log
+from enaml.application import Application, deferred_call, timed_call
 from .part import Part
 
-from OCC.TopoDS import TopoDS_Compound
-from OCC.BRep import BRep_Builder
 
 class ExportError(Exception):
     """ Raised if export failed """
 
 
+class ExportCancelled(Exception):
+    """ Raised within the export when the job is cancelled """
+
+
 class ExportOptions(Model):
+    #: Id of the exporter to use
+    format = Unicode('stl')
+
     path = Unicode()
     linear_deflection = Float(0.05, strict=False)
     angular_deflection = Float(0.5, strict=False)
     relative = Bool()
     binary = Bool(False)
 
+    #: Write each part to a separate file
+    split = Bool(False)
+
+    #: Number of processes used to mesh the parts (0 uses all cores)
+    jobs = Int(0)
+
+
+class ExportShape(Atom):
+    """ A shape to export with it's display properties. These are collected
+    on the main thread so the exporter never touches the declarations.
+
+    """
+    #: Name safe to use in a filename
+    name = Unicode()
+
+    #: The TopoDS_Shape
+    shape = Value()
+
+    #: Color as an (r, g, b) tuple of floats from 0 to 1 or empty
+    color = Tuple()
+
+    #: Transparency from 0 to 1
+    transparency = Float(strict=False)
+
+
+class ExportJob(Atom):
+    """ Tracks the progress of an export running in the background. """
+
+    #: Exporter used
+    exporter = Instance(object)
+
+    #: Options of the export
+    options = Instance(ExportOptions)
+
+    #: Shapes to export
+    shapes = List(ExportShape)
+
+    #: Progress from 0 to 100
+    progress = Int()
+
+    #: Description of the current step
+    message = Unicode()
+
+    #: Set to request the export to stop
+    cancelled = Bool()
+
+    #: Set once the job is finished (whether it succeeded or not)
+    done = Bool()
+
+    #: Error message if the export failed
+    error = Unicode()
+
+    #: Files written
+    paths = List()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def update(self, progress, message=''):
+        """ Report the progress of the export. This is called by the
+        exporter and may be called from any thread.
+
+        Raises
+        ------
+            ExportCancelled: If the job was cancelled
+
+        """
+        if self.cancelled:
+            raise ExportCancelled()
+        self._set(progress=int(progress), message=message)
+
+    def run(self):
+        """ Run the export in the current thread """
+        try:
+            paths = self.exporter.export(self)
+            self._set(paths=paths or [], progress=100, message='Done')
+        except ExportCancelled:
+            self._set(message='Cancelled')
+        except Exception as e:
+            log.error("Export failed: {}".format(traceback.format_exc()))
+            self._set(error=str(e) or type(e).__name__)
+        finally:
+            self._set(done=True)
+
+    def _set(self, **kwargs):
+        """ Update the state on the main thread (if the application is
+        running) so it's safe to bind to the ui.
+
+        """
+        if Application.instance() is None:
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+        else:
+            deferred_call(self._apply, kwargs)
+
+    def _apply(self, kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+class Exporter(Atom):
+    """ Base class for exporters. Subclass and add it with
+    `register_exporter` to support a new format.
+
+    """
+
+    #: Unique id of the exporter
+    id = Unicode()
+
+    #: Name shown in the ui
+    name = Unicode()
+
+    #: File extension including the "."
+    extension = Unicode()
+
+    #: Whether the exporter uses the mesh (deflection) options
+    meshed = Bool()
+
+    #: Whether the exporter wants each displayed shape separately (with
+    #: their own color) instead of one shape per part
+    expand = Bool()
+
+    def export(self, job):
+        """ Export the shapes of the job. This is called from a worker
+        thread. Call `job.update` to report progress and to stop if the
+        job was cancelled.
+
+        Returns
+        -------
+            paths: List of str
+                The files written
+
+        """
+        raise NotImplementedError
+
+
+#: Registry of exporters by id
+EXPORTERS = OrderedDict()
+
+
+def register_exporter(exporter):
+    """ Add an exporter to the registry replacing any existing one with the
+    same id.
+
+    """
+    EXPORTERS[exporter.id] = exporter
+
+
+def get_exporters():
+    """ Get the registered exporters loading the defaults if needed """
+    if not EXPORTERS:
+        from .impl.occ_export import register_default_exporters
+        register_default_exporters()
+    return EXPORTERS
+
 
 class ViewerPlugin(Plugin):
     #: List of parts to display
     parts = List(Part)
 
+    #: Save expensive shapes to disk so they can be reused across sessions
+    disk_cache_enabled = Bool(True).tag(config=True)
+
+    #: Size limit of the disk cache in MB
+    disk_cache_limit = Int(1024).tag(config=True)
+
+    def start(self):
+        super(ViewerPlugin, self).start()
+        self._refresh_disk_cache()
+
+    @observe('disk_cache_enabled', 'disk_cache_limit')
+    def _refresh_disk_cache(self, change=None):
+        from .impl.occ_cache import DISK_CACHE
+        DISK_CACHE.enabled = self.disk_cache_enabled
+        DISK_CACHE.limit = self.disk_cache_limit*1024*1024
+
     def _observe_parts(self, change):
         """ When changed, do a fit all """
         if change['type'] == 'update':
@@ -44,43 +226,141 @@ class ViewerPlugin(Plugin):
         viewer = self.get_viewer()
         viewer.proxy.display.FitAll()
 
+    # -------------------------------------------------------------------------
+    # Cache API
+    # -------------------------------------------------------------------------
+    def cache_stats(self, event=None):
+        """ Get the stats of the memory and disk shape caches, the mesh
+        service, and the rebuild scheduler.
+        
+        Returns
+        -------
+            stats: dict
+                Dict with the 'memory' and 'disk' cache, 'mesh' and
+                'rebuild' stats
+        
+        """
+        from .impl.occ_cache import SHAPE_CACHE, DISK_CACHE
+        from .impl.occ_mesh import MESH_SERVICE
+        from .impl.occ_scheduler import SCHEDULER
+        return {
+            'memory': SHAPE_CACHE.stats(),
+            'disk': DISK_CACHE.stats(),
+            'mesh': MESH_SERVICE.stats(),
+            'rebuild': SCHEDULER.stats(),
+        }
+
+    def rebuild_counts(self, event=None):
+        """ Get the number of times each shape of the parts was rebuilt by
+        the scheduler.
+        
+        Returns
+        -------
+            counts: List of tuple
+                The (declaration, count) of each shape rebuilt at least once
+                sorted by the count
+        
+        """
+        counts = []
+        proxies = [p.proxy for p in self.parts]
+        while proxies:
+            proxy = proxies.pop()
+            if getattr(proxy, 'rebuild_count', 0):
+                counts.append((proxy.declaration, proxy.rebuild_count))
+            proxies.extend(proxy.children())
+        return sorted(counts, key=lambda c: c[1], reverse=True)
+
+    def clear_cache(self, event=None):
+        """ Clear the memory and disk shape caches """
+        from .impl.occ_cache import SHAPE_CACHE, DISK_CACHE
+        from .impl.occ_mesh import MESH_SERVICE
+        SHAPE_CACHE.clear()
+        DISK_CACHE.clear()
+        MESH_SERVICE.clear()
+
     def get_viewer(self):
         ui = self.workbench.get_plugin('enaml.workbench.ui')
         area = ui.workspace.content.find('dock_area')
         return area.find('viewer-item').viewer
 
     def export(self, event):
-        """ Export the current model to stl """
-        from OCC.StlAPI import StlAPI_Writer
-        from OCC.BRepMesh import BRepMesh_IncrementalMesh
-        #: TODO: All parts
+        """ Export the current model in the background using the exporter
+        of the format selected in the options.
+        
+        Returns
+        -------
+            job: ExportJob
+                The job which can be observed for progress or cancelled
+        
+        """
         options = event.parameters.get('options')
         if not isinstance(options, ExportOptions):
             return False
+        exporter = get_exporters().get(options.format)
+        if exporter is None:
+            raise ExportError("No exporter for {}".format(options.format))
+        shapes = self.get_export_shapes(exporter.expand)
+        if not shapes:
+            raise ExportError("There are no parts to export")
+        job = ExportJob(exporter=exporter, options=options, shapes=shapes)
+        thread = threading.Thread(target=job.run, name='declaracad-export')
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def get_export_shapes(self, expand=False):
+        """ Collect the shapes of the parts to export.
+        
+        Parameters
+        ----------
+            expand: bool
+                Return each displayed shape of the parts with it's own color
+                instead of one shape per part
+        
+        """
+        return collect_export_shapes(self.parts, expand)
+
+
+def collect_export_shapes(parts, expand=False):
+    """ Collect the shapes of the given parts to export.
+    
+    Parameters
+    ----------
+        parts: List of Part
+            Activated parts to export
+        expand: bool
+            Return each displayed shape of the parts with it's own color
+            instead of one shape per part
+    
+    Returns
+    -------
+        shapes: List of ExportShape
+            The shapes to pass to an ExportJob
+    
+    """
+    shapes = []
+    for i, part in enumerate(parts):
+        #: Make the name safe to use in a filename
+        name = re.sub(r'[^\w\-.]+', '_', part.name or 'part{}'.format(i))
+        if not expand:
+            shapes.append(_export_shape(name, part.proxy))
+            continue
+        for j, proxy in enumerate(_expand_shapes(part.proxy)):
+            shapes.append(_export_shape('{}-{}'.format(name, j), proxy))
+    return shapes
+
+
+def _expand_shapes(proxy):
+    if hasattr(proxy, 'shapes'):
+        return [s for c in proxy.shapes for s in _expand_shapes(c)]
+    return [proxy]
+
 
-        exporter = StlAPI_Writer()
-        exporter.SetASCIIMode(not options.binary)
-
-        #: Make a compound of compounds (if needed)
-        compound = TopoDS_Compound()
-        builder = BRep_Builder()
-        builder.MakeCompound(compound)
-        for part in self.parts:
-            #: Must mesh the shape first
-            if isinstance(part, Part):
-                builder.Add(compound, part.proxy.shape)
-            else:
-                builder.Add(compound, part.proxy.shape.Shape())
-
-        #: Build the mesh
-        mesh = BRepMesh_IncrementalMesh(
-            compound,
-            options.linear_deflection,
-            options.relative,
-            options.angular_deflection
-        )
-        mesh.Perform()
-        if not mesh.IsDone():
-            raise ExportError("Failed to create the mesh")
-
-        exporter.Write(compound, options.path)
+def _export_shape(name, proxy):
+    from .impl.occ_export import color_rgb
+    d = proxy.declaration
+    shape = proxy.shape
+    if hasattr(shape, 'Shape'):
+        shape = shape.Shape()
+    return ExportShape(name=name, shape=shape, color=color_rgb(d.color),
+                       transparency=d.transparency)
@@ -11,10 +11,12 @@ Based on https://github.com/tpaviot/pythonocc-core/
 import sys
 import logging
 import traceback
-from atom.api import Dict, Typed, Int, Property
+from atom.api import Dict, Typed, Property
 
 from OCC.Display import OCCViewer
 from ..impl.occ_part import OccPart
+from ..impl.occ_mesh import MESH_SERVICE
+from ..impl.occ_scheduler import SCHEDULER
 from ..widgets.occ_viewer import ProxyOccViewer
 
 from enaml.qt import QtCore, QtGui
@@ -23,7 +25,6 @@ from PyQt5 import QtOpenGL
 from enaml.qt.QtCore import Qt
 from enaml.qt.qt_control import QtControl
 from enaml.qt.qt_toolkit_object import QtToolkitObject
-from enaml.application import timed_call
 from OCC.BRepBuilderAPI import BRepBuilderAPI_MakeShape
 from OCC import Graphic3d
 
@@ -414,12 +415,13 @@ class QtOccViewer(QtControl, ProxyOccViewer):
     #: Viewer widget
     widget = Typed(QtViewer3d)
     
-    #: Update count
-    _update_count = Int(0)
-    
     #: Displayed Shapes
     _displayed_shapes = Dict()
     
+    #: Displayed AIS objects keyed by proxy. Each value is a tuple of
+    #: (shape, display key, ais handle) used to diff the next update.
+    _displayed_ais = Dict()
+    
     #: Shapes
     shapes = Property(lambda self: self.get_shapes(), cached=True)
     
@@ -570,27 +572,19 @@ class QtOccViewer(QtControl, ProxyOccViewer):
                                                      self._displayed_shapes))
         d.selection = selection
         
-#     def _queue_update(self,change):
-#         self._update_count +=1
-#         timed_call(0,self._check_update,change)
-#     
-#     def _dequeue_update(self,change):
-#         # Only update when all changes are done
-#         self._update_count -=1
-#         if self._update_count !=0:
-#             return
-#         self.update_shape(change)
-            
     def update_display(self, change=None):
-        self._update_count += 1
+        """ Redisplay once all the shapes changed in this batch are rebuilt
+        
+        """
         log.debug('update_display')
-        timed_call(10, self._do_update)
+        SCHEDULER.schedule(self, self._do_update, change)
         
     def clear_display(self):
         display = self.display
         # Erase all just hides them
         display.Context.PurgeDisplay()
         display.Context.RemoveAll()
+        self._displayed_ais = {}
     
     def _expand_shapes(self, shapes):
         expansion = []
@@ -600,28 +594,62 @@ class QtOccViewer(QtControl, ProxyOccViewer):
                     expansion.extend(self._expand_shapes(c.shapes))
             if hasattr(s, 'shapes'):
                 expansion.extend(self._expand_shapes(s.shapes))
+            elif getattr(s, 'loading', False) and not s.shape:
+                #: Show the placeholders of the children until they're loaded
+                expansion.extend(self._expand_shapes(
+                    [c for c in s.children() if hasattr(c, 'loading')]))
             else:
                 expansion.append(s)
         return expansion
+
+    def _display_key(self, shape):
+        """ Return a key of the display properties of the shape. If the key
+        changes the AIS object must be recreated.
+        
+        """
+        d = shape.declaration
+        return (d.color, d.material, d.transparency)
+
+    def _display_ais(self, shape, s):
+        """ Create and display a new AIS object for the given proxy. """
+        d = shape.declaration
+
+        #: If a material is given
+        material = getattr(Graphic3d, 'Graphic3d_NOM_{}'.format(
+            d.material.upper()
+        )) if d.material else None
+
+        self._mesh(s)
+        return self.display.DisplayShape(
+            s, color=d.color, material=material,
+            transparency=d.transparency)
+
+    def _mesh(self, s):
+        """ Mesh the shape with the deflection used by the AIS presentation
+        using the shared mesh service so it can be reused when exporting.
+        
+        """
+        try:
+            MESH_SERVICE.mesh(s, *MESH_SERVICE.display_deflection(s))
+        except Exception as e:
+            #: The presentation will mesh it
+            log.debug("Failed to mesh {}: {}".format(s, e))
     
-    def _do_update(self):
-        # Only update when all changes are done
-        self._update_count -= 1
-        if self._update_count != 0:
-            return
-        #: TO
+    def _do_update(self, change=None):
         try:
             display = self.display
-
-            self.clear_display()
+            context = display.Context
+            first = not self._displayed_ais
             displayed_shapes = {}
+            displayed_ais = {}
+            stats = {'displayed': 0, 'redisplayed': 0, 'removed': 0,
+                     'unchanged': 0}
             log.debug("_do_update {}")
 
             #: Expand all parts otherwise we lose the material information
             shapes = self._expand_shapes(self.shapes[:])
 
             for shape in shapes:
-                d = shape.declaration
                 if not shape.shape:
                     log.error("{} has no shape property!".format(shape))
                     continue
@@ -635,23 +663,51 @@ class QtOccViewer(QtControl, ProxyOccViewer):
                     log.error("{} failed to create shape: {}".format(
                         shape, traceback.format_exc()))
                     continue
-                    
-                displayed_shapes[s] = shape
 
-                #: If a material is given
-                material = getattr(Graphic3d, 'Graphic3d_NOM_{}'.format(
-                    d.material.upper()
-                )) if d.material else None
-
-                #: If last shape
-                update = shape == shapes[-1]
-
-                ais_shape = display.DisplayShape(
-                    s, color=d.color, material=material,
-                    transparency=d.transparency,
-                    update=update, fit=not self._displayed_shapes)
+                displayed_shapes[s] = shape
+                key = self._display_key(shape)
+                entry = self._displayed_ais.pop(shape, None)
+
+                if entry is not None:
+                    old_shape, old_key, ais = entry
+                    if old_key != key:
+                        #: Display properties changed, recreate it
+                        context.Remove(ais, False)
+                        stats['removed'] += 1
+                    elif old_shape.IsEqual(s):
+                        stats['unchanged'] += 1
+                        displayed_ais[shape] = entry
+                        continue
+                    else:
+                        #: Only the shape changed, reuse the AIS object
+                        self._mesh(s)
+                        ais.GetObject().Set(s)
+                        context.Redisplay(ais, False)
+                        stats['redisplayed'] += 1
+                        displayed_ais[shape] = (s, key, ais)
+                        continue
+
+                ais = self._display_ais(shape, s)
+                stats['displayed'] += 1
+                displayed_ais[shape] = (s, key, ais)
+
+            #: Anything left over is no longer displayed
+            for old_shape, old_key, ais in self._displayed_ais.values():
+                context.Remove(ais, False)
+                stats['removed'] += 1
 
             self._displayed_shapes = displayed_shapes
+            self._displayed_ais = displayed_ais
+
+            touched = stats['displayed'] + stats['redisplayed'] + \
+                stats['removed']
+            if touched:
+                if first:
+                    display.FitAll()
+                display.Repaint()
+            log.debug("Updated display: {} AIS objects touched ({})".format(
+                touched, stats))
+            self.declaration.update_stats = stats
         except:
             log.error("Failed to display shapes: {}".format(
                 traceback.format_exc()))
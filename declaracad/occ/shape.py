@@ -205,6 +205,12 @@ class ProxyLoadShape(ProxyShape):
     def set_loader(self, loader):
         raise NotImplementedError
 
+    def set_asynchronous(self, asynchronous):
+        raise NotImplementedError
+
+    def set_convert(self, convert):
+        raise NotImplementedError
+
 
 class Shape(ToolkitObject):
     """ Abstract shape component that can be displayed on the screen 
@@ -875,7 +881,23 @@ class LoadShape(Shape):
     
     path: String
         The path of the 3D model to load. Supported types are, .stl, .stp,
-        .igs, and .brep
+        .igs, and .brep. The imported shape is cached (in memory and on disk
+        as BRep) until the file is modified.
+    asynchronous: Bool
+        Import the file in a worker process. A box is displayed in place of
+        the shape until it's loaded and any operations using it are only
+        updated once it's done.
+    loader: Enum
+        The loader to use, by default it's determined from the extension.
+        The 'mesh' loader reads an STL file into a single face with the
+        triangulation which is much faster to load and display than the
+        'stl' loader which creates a face for every triangle.
+    convert: Bool
+        Convert a mesh into a BRep when it's used in a boolean operation.
+        This can be very slow for large meshes so it must be enabled.
+    error: String
+        Set to the error if the asynchronous import failed. The placeholder
+        is kept in place of the shape.
     
     
     Examples
@@ -893,9 +915,18 @@ class LoadShape(Shape):
     path = d_(Str())
 
     #: Loader to use
-    loader = d_(Enum('auto', 'stl', 'stp', 'caf', 'iges', 'brep'))
+    loader = d_(Enum('auto', 'stl', 'stp', 'caf', 'iges', 'brep', 'mesh'))
+
+    #: Import the file in the background
+    asynchronous = d_(Bool(False))
+
+    #: Convert a mesh into a BRep when used in an operation
+    convert = d_(Bool(False))
+
+    #: Error of the last import (if it failed)
+    error = Str()
 
-    @observe('path', 'type')
+    @observe('path', 'loader', 'asynchronous', 'convert')
     def _update_proxy(self, change):
         """ Base class implementation is sufficient"""
         super(LoadShape, self)._update_proxy(change)
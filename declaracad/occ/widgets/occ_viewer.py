@@ -4,7 +4,7 @@ Created on Sep 26, 2016
 @author: jrm
 """
 from atom.api import (
-   Event, List, Tuple, Bool, Int, Enum, Typed, ForwardTyped, observe,
+   Event, List, Dict, Tuple, Bool, Int, Enum, Typed, ForwardTyped, observe,
    set_default
 )
 from enaml.core.declarative import d_
@@ -81,6 +81,10 @@ class OccViewer(Control):
     #: Selected items
     selection = d_(List(), writable=False)
     
+    #: Number of AIS objects displayed, redisplayed, removed, and unchanged
+    #: in the last display update
+    update_stats = d_(Dict(), writable=False)
+    
     #: View direction
     view_mode = d_(Enum('iso', 'top', 'bottom', 'left', 'right', 'front',
                         'rear'))
@@ -18,5 +18,5 @@ setup(
     url='https://github.com/codelv/declaracad',
     packages=find_packages(),
     install_requires=['enaml', 'jsonpickle', 'qtconsole', 'pyflakes',
-                      'QScintilla', 'numpydoc', 'markdown'],
+                      'QScintilla', 'numpydoc', 'markdown', 'numpy'],
 )
\ No newline at end of file